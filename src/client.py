@@ -6,6 +6,7 @@ import sys
 import time
 import datetime
 import json
+from urllib import urlencode
 from urllib2 import HTTPError, URLError
 from httplib import HTTPException
 
@@ -20,8 +21,8 @@ usage="./client.py --username USERNAME --password PASSWORD --gh HOSTNAME --gp PO
 usage += "./client.py --username USERNAME --password PASSWORD --kj JOB_ID\n"
 usage += "./client.py --username USERNAME --password PASSWORD -s SCHEDULER\n"
 usage += "./client.py --username USERNAME --password PASSWORD --jo JOB_ID\n"
-usage += "./client.py --username USERNAME --password PASSWORD --js JOB_ID\n"
-usage += "./client.py --username USERNAME --password PASSWORD --gs"
+usage += "./client.py --username USERNAME --password PASSWORD --js JOB_ID [--st STATUS]\n"
+usage += "./client.py --username USERNAME --password PASSWORD --gs [--st STATUS]"
 
 parser = OptionParser(usage)
 
@@ -86,6 +87,12 @@ parser.add_option("--gs", "--grid_status", dest="grid_status",
 	help="Request the status of The Grid",
 	metavar="GRID_STATUS")
 
+parser.add_option("--st", "--status", dest="status",
+	action="append",
+	help="With --js, only show work units with this status. With --gs, list the jobs with this status, " + 
+		"READY and RUNNING by default. May be given more than once.",
+	metavar="STATUS")
+
 (options, args) = parser.parse_args()
 
 auth_header = auth_header(options.username, options.password)
@@ -134,6 +141,8 @@ if options.job_id:
 if options.job_id_status:
 	try:
 		url = '%s/job/%s' % (grid_url, options.job_id_status)
+		if options.status:
+			url += "?" + urlencode([ ('unit_status', status) for status in options.status ])
 		request = JSONHTTPRequest( 'GET', url, "", auth_header )
 	except (HTTPError, URLError) as e:
 		client_utils.request_error(e, "Could not get the status of job %s from The Grid" % options.job_id_status)
@@ -231,6 +240,22 @@ if options.grid_status:
 			print "Next free: %s" % time.asctime(time.localtime(earliest_end))
 		print
 
+	# List the jobs with the requested statuses, without their work units
+	statuses = options.status or [ "READY", "RUNNING" ]
+	try:
+		url = '%s/job?%s' % (grid_url, urlencode([ ('summary', 1) ] + [ ('status', status) for status in statuses ]))
+		request = JSONHTTPRequest( 'GET', url, "", auth_header )
+	except (HTTPError, URLError) as e:
+		client_utils.request_error(e, "Could not retrieve the jobs on The Grid")
+		sys.exit(1)
+
+	print "%s Jobs:" % ", ".join(statuses).title()
+	for job_id in sorted(request.response, key = int):
+		job = request.response[job_id]
+		counts = job['work_unit_counts']
+		print "Job %s: %s [%s] %s, %d of %d work units done" % (job_id, job['name'], job['job_type'], 
+			job['status'], counts.get('FINISHED', 0) + counts.get('KILLED', 0), sum(counts.values()))
+
 	sys.exit(1)
 
 
@@ -4,26 +4,82 @@ import urllib
 import urllib2
 import mimetypes
 import base64
+import hashlib
+import tempfile
+import threading
 from urlparse import parse_qs
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
 
 import BaseHTTPServer
 
 OK = 200
+PARTIAL_CONTENT = 206
+NOT_MODIFIED = 304
 BAD_REQUEST = 400
 NOT_FOUND = 404
 METHOD_NOT_ALLOWED = 405
+REQUEST_ENTITY_TOO_LARGE = 413
+RANGE_NOT_SATISFIABLE = 416
+SERVICE_UNAVAILABLE = 503
+
+# The header a file's SHA-256 is sent in, as hex
+CHECKSUM_HEADER = 'X-Content-SHA256'
+
+# The size of the chunks files are read and written in
+CHUNK_SIZE = 64 * 1024
 
 def auth_header(username, password):
 	base64string = base64.encodestring('%s:%s' % (username, password)).replace('\n', '')
 	return { "Authorization": "Basic %s" % base64string }  
 
+#
+# decode_auth_header(auth_header)
+#
+# Returns the (username, password) of a Basic Authorization
+# header, or None if it can't be decoded. The last AUTH_CACHE_SIZE
+# headers decoded are cached, as clients and nodes send the same
+# header with every request.
+#
+
+AUTH_CACHE_SIZE = 256
+
+auth_cache = OrderedDict()
+auth_cache_lock = threading.Lock()
+
+def decode_auth_header(auth_header):
+	with auth_cache_lock:
+		credentials = auth_cache.pop(auth_header, None)
+		if credentials is not None:
+			auth_cache[ auth_header ] = credentials
+			return credentials
+
+	try:
+		auth_string = base64.b64decode(auth_header.partition('Basic ')[2])
+		credentials = tuple(auth_string.split(':', 1))
+	except (TypeError, ValueError):
+		return None
+
+	if len(credentials) != 2:
+		return None
+
+	with auth_cache_lock:
+		auth_cache[ auth_header ] = credentials
+		if len(auth_cache) > AUTH_CACHE_SIZE:
+			auth_cache.popitem(last = False)
+
+	return credentials
+
 #
 # @authenticate decorator
 #
+# users is a list of (username, password), which is made into
+# a set once when the decorator is created.
+#
 
 class authenticate(object):
 	def __init__(self, users):
-		self.users = users
+		self.users = frozenset(users)
 
 	def __call__(self, func):
 		def decorator_func(request, *args, **kwargs):
@@ -32,13 +88,7 @@ class authenticate(object):
 			except KeyError:
 				return AuthResponse()
 
-			try:
-				auth_string = base64.b64decode(auth_header.partition('Basic ')[2])
-				(username, password) = auth_string.split(':', 1)
-			except ValueError:
-				return AuthResponse()
-
-			if (username, password) not in self.users:
+			if decode_auth_header(auth_header) not in self.users:
 				return AuthResponse()
 
 			return func(request, *args, **kwargs)
@@ -78,9 +128,23 @@ class Response(object):
 		responses = BaseHTTPServer.BaseHTTPRequestHandler.responses
 		return str(self.status) + " " + responses[self.status][0]
 
+#
+# FileResponse
+#
+# Serves a file under www, streamed from disk in CHUNK_SIZE
+# chunks rather than read into memory. Whole files are handed to 
+# the server's wsgi.file_wrapper where it has one, which may use
+# sendfile.
+#
+# Given the request, a FileResponse also answers conditional
+# requests with 304 Not Modified, using the file's ETag and 
+# Last-Modified, and a single byte range Range request with 
+# 206 Partial Content, so downloads can be resumed.
+#
+
 class FileResponse(Response):
-	
-	def __init__(self, filename, headers = None):
+
+	def __init__(self, filename, headers = None, request = None):
 
 		if headers == None:
 			headers = []
@@ -88,24 +152,152 @@ class FileResponse(Response):
 		root = "www"
 		path = filename
 
+		self.env = request.env if request is not None else {}
+		self.path = None
+
 		# Check for file injection and existance
-		if not os.path.normpath(path).startswith(root) or not os.path.exists(path):	
-			status = 404
-			body = ""
+		if not os.path.normpath(path).startswith(root) or not os.path.isfile(path):	
+			super(FileResponse, self).__init__("", NOT_FOUND, headers)
+			return
+
+		super(FileResponse, self).__init__("", OK, headers)
+
+		stat = os.stat(path)
+		size = stat.st_size
+		etag = '"%x-%x"' % (int(stat.st_mtime), size)
+		last_modified = formatdate(int(stat.st_mtime), usegmt = True)
+
+		self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+		self.add_headers([
+			('ETag', etag),
+			('Last-Modified', last_modified),
+			('Accept-Ranges', 'bytes'),
+		])
+
+		if is_not_modified(self.env, etag, int(stat.st_mtime)):
+			self.status = NOT_MODIFIED
+			return
+
+		byte_range = None
+		if_range = self.env.get('HTTP_IF_RANGE')
+		if 'HTTP_RANGE' in self.env and if_range in (None, etag, last_modified):
+			byte_range = parse_range(self.env['HTTP_RANGE'], size)
+
+		if byte_range is False:
+			self.status = RANGE_NOT_SATISFIABLE
+			self.add_headers([ 
+				('Content-Range', 'bytes */%d' % size),
+				('Content-Length', '0')
+			])
+			return
 
-		# Respond with the file
+		if byte_range is None:
+			self.offset, self.length = 0, size
 		else:
-			status = 200
-
-			body = file(path, "r").read()
-			self.content_type = mimetypes.guess_type(path)[0]
-			length = os.path.getsize(path)
-			headers.extend([ 
-				('Content-Type', self.content_type), 
-				('Content-Length', length) 
-			])
+			start, end = byte_range
+			self.status = PARTIAL_CONTENT
+			self.offset, self.length = start, end - start + 1
+			self.add_headers([ ('Content-Range', 'bytes %d-%d/%d' % (start, end, size)) ])
 
-		super(FileResponse, self).__init__(body, status, headers)
+		self.path = path
+		self.add_headers([
+			('Content-Type', self.content_type), 
+			('Content-Length', str(self.length)) 
+		])
+
+	def get_response(self, start_response):
+		if self.path is None:
+			return super(FileResponse, self).get_response(start_response)
+
+		fp = open(self.path, "rb")
+		start_response(self.status_string, self.headers)
+
+		# The file wrapper sends the whole file, so can't be used 
+		# for a range
+		if self.status == OK and 'wsgi.file_wrapper' in self.env:
+			return self.env['wsgi.file_wrapper'](fp, CHUNK_SIZE)
+
+		fp.seek(self.offset)
+		return stream_file(fp, self.length)
+
+#
+# read_chunks(fp, length, chunk_size)
+#
+# Yields up to length bytes from a file-like object in chunks
+#
+
+def read_chunks(fp, length, chunk_size):
+	while length > 0:
+		chunk = fp.read(min(chunk_size, length))
+		if not chunk:
+			break
+		length -= len(chunk)
+		yield chunk
+
+#
+# stream_file(fp, length)
+#
+# Yields up to length bytes from the file in CHUNK_SIZE chunks, 
+# and closes the file when done or when the generator is closed
+#
+
+def stream_file(fp, length):
+	try:
+		for chunk in read_chunks(fp, length, CHUNK_SIZE):
+			yield chunk
+	finally:
+		fp.close()
+
+#
+# is_not_modified(env, etag, mtime)
+#
+# Whether the request's If-None-Match or If-Modified-Since
+# headers show the client already has this version of a file
+#
+
+def is_not_modified(env, etag, mtime):
+	if 'HTTP_IF_NONE_MATCH' in env:
+		etags = [ tag.strip() for tag in env['HTTP_IF_NONE_MATCH'].split(',') ]
+		return etag in etags or '*' in etags
+
+	if 'HTTP_IF_MODIFIED_SINCE' in env:
+		since = parsedate_tz(env['HTTP_IF_MODIFIED_SINCE'])
+		return since is not None and mtime <= mktime_tz(since)
+
+	return False
+
+#
+# parse_range(header, size)
+#
+# Returns the (start, end) byte positions, inclusive, asked for by
+# a Range header, False if the range can't be satisfied, or None
+# if the header should be ignored. Only a single range is 
+# supported; asking for several gets the whole file.
+#
+
+def parse_range(header, size):
+	unit, _, spec = header.partition('=')
+	if unit.strip() != 'bytes' or ',' in spec:
+		return None
+
+	start, _, end = spec.strip().partition('-')
+	try:
+		# The last end bytes
+		if start == '':
+			length = int(end)
+			if length <= 0 or size == 0:
+				return False
+			return (max(size - length, 0), size - 1)
+
+		start = int(start)
+		end = int(end) if end != '' else size - 1
+	except ValueError:
+		return None
+
+	if start >= size or end < start:
+		return False
+
+	return (start, min(end, size - 1))
 
 class AuthResponse(Response):
 	
@@ -127,6 +319,22 @@ class JSONResponse(Response):
 	def body(self, body):
 		self._body = json.dumps(body)
 
+#
+# RawJSONResponse
+#
+# A JSONResponse whose body has already been encoded
+#
+
+class RawJSONResponse(JSONResponse):
+
+	@property
+	def body(self):
+		return self._body
+
+	@body.setter
+	def body(self, body):
+		self._body = body
+
 
 #
 # @require_json decorator
@@ -157,11 +365,76 @@ class Request(object):
 			return self.env['wsgi.input'].read(int(self.length))
 		else:
 			return None
+
+	#
+	# @property checksum
+	#
+	# The SHA-256 the client sent for the body, or None
+	#
+
+	@property
+	def checksum(self):
+		checksum = self.env.get('HTTP_' + CHECKSUM_HEADER.upper().replace('-', '_'))
+		return checksum.strip().lower() if checksum else None
 		
-	def raw_to_file(self, filename):
-		fp = open(filename, "w+")
-		fp.write(self.raw)
-		fp.close()
+	#
+	# raw_to_file(self, filename, max_size = None)
+	#
+	# Streams the body to a temporary file next to filename in
+	# CHUNK_SIZE chunks, then renames it over filename, so the body
+	# is never held in memory and a failed upload never leaves a
+	# partial file behind. Returns the SHA-256 of the body, as hex.
+	#
+	# Raises UploadTooLargeException if the body is larger than 
+	# max_size bytes, IncompleteUploadException if the client sent 
+	# less than its Content-Length, and ChecksumMismatchException if 
+	# the client sent a checksum which doesn't match the body.
+	#
+
+	def raw_to_file(self, filename, max_size = None):
+		length = int(self.length or 0)
+		if max_size is not None and length > max_size:
+			raise UploadTooLargeException("Upload of %d bytes is larger than the limit of %d bytes." 
+				% (length, max_size))
+
+		fd, tmp_path = tempfile.mkstemp(
+			dir = os.path.dirname(filename) or ".", 
+			prefix = ".%s." % os.path.basename(filename)
+		)
+
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				checksum = hashlib.sha256()
+
+				# The body has already been read
+				if getattr(self, '_raw_cache', None) is not None:
+					chunks = [ self._raw_cache ]
+				else:
+					chunks = read_chunks(self.env['wsgi.input'], length, CHUNK_SIZE)
+
+				received = 0
+				for chunk in chunks:
+					fp.write(chunk)
+					checksum.update(chunk)
+					received += len(chunk)
+
+			if received < length:
+				raise IncompleteUploadException("Upload ended after %d of %d bytes." 
+					% (received, length))
+
+			checksum = checksum.hexdigest()
+			if self.checksum is not None and self.checksum != checksum:
+				raise ChecksumMismatchException("Upload checksum %s does not match %s." 
+					% (checksum, self.checksum))
+
+			# mkstemp creates the file readable only by its owner
+			os.chmod(tmp_path, 0644)
+			os.rename(tmp_path, filename)
+		except:
+			os.remove(tmp_path)
+			raise
+
+		return checksum
 
 	@property
 	def raw(self):
@@ -221,13 +494,139 @@ class FileHTTPRequest(HTTPRequest):
 
 		# Files need their content-length specified directly as 
 		# you cannot take the length() of a file pointer
-		self.headers = { 'Content-length': length }
+		self.headers = { 
+			'Content-length': length,
+			CHECKSUM_HEADER: file_checksum(filename),
+		}
 		self.headers.update(headers)
 
 		super(FileHTTPRequest, self).__init__(method, url, file_data, self.headers)
 
 		file_data.close()
 
+#
+# FileDownload
+#
+# Downloads a file to disk, streamed in CHUNK_SIZE chunks. The 
+# file is written to filename.part and renamed to filename once it 
+# is complete, and has the size and SHA-256 (if the server sent
+# one) the server said it would.
+#
+# A download that fails part way can be resumed by calling
+# attempt() again, which asks for the rest of the file with a Range
+# request. If the file changed on the server since the last attempt
+# the server sends all of it, and the download starts again.
+#
+
+class FileDownload(object):
+
+	TIMEOUT = 30
+
+	def __init__(self, url, filename, headers = None):
+		if headers == None:
+			headers = {}
+
+		self.url = url
+		self.filename = filename
+		self.part_path = filename + ".part"
+		self.headers = headers
+
+		# The ETag of the file when it was last downloaded from
+		self.etag = None
+
+	#
+	# attempt(self)
+	#
+	# Downloads the file, or the rest of it. Returns the SHA-256
+	# of the file, as hex. Raises IncompleteDownloadException or
+	# CorruptDownloadException if the file didn't arrive intact,
+	# or the errors of urllib2 if the request failed.
+	#
+
+	def attempt(self):
+		headers = dict(self.headers)
+
+		offset = 0
+		if self.etag is not None and os.path.exists(self.part_path):
+			offset = os.path.getsize(self.part_path)
+			headers.update({ 
+				'Range': 'bytes=%d-' % offset,
+				'If-Range': self.etag 
+			})
+
+		request = urllib2.Request(self.url, None, headers)
+
+		try:
+			response = urllib2.urlopen(request, timeout = self.TIMEOUT)
+		except urllib2.HTTPError as e:
+			# What we have is longer than the file now is
+			if e.code == RANGE_NOT_SATISFIABLE:
+				self.discard()
+			raise
+
+		try:
+			info = response.info()
+			self.etag = info.getheader('ETag')
+			checksum = info.getheader(CHECKSUM_HEADER)
+
+			content_range = info.getheader('Content-Range')
+			if response.getcode() == PARTIAL_CONTENT and content_range is not None:
+				start, size = parse_content_range(content_range)
+				if start != offset:
+					raise CorruptDownloadException("Asked for %s from %d, received from %d." 
+						% (self.url, offset, start))
+				mode = "ab"
+			else:
+				offset = 0
+				size = int(info.getheader('Content-Length'))
+				mode = "wb"
+
+			with open(self.part_path, mode) as fp:
+				for chunk in iter(lambda: response.read(CHUNK_SIZE), ""):
+					fp.write(chunk)
+		finally:
+			response.close()
+
+		received = os.path.getsize(self.part_path)
+		if received != size:
+			raise IncompleteDownloadException("Received %d of %d bytes of %s." 
+				% (received, size, self.url))
+
+		actual = file_checksum(self.part_path)
+		if checksum is not None and checksum.strip().lower() != actual:
+			self.discard()
+			raise CorruptDownloadException("Checksum of %s does not match %s." % (self.url, checksum))
+
+		os.rename(self.part_path, self.filename)
+		return actual
+
+	#
+	# discard(self)
+	#
+	# Removes what has been downloaded, so the next attempt
+	# starts from the beginning
+	#
+
+	def discard(self):
+		self.etag = None
+		if os.path.exists(self.part_path):
+			os.remove(self.part_path)
+
+#
+# parse_content_range(header)
+#
+# Returns the start and the full size of the file from
+# a Content-Range header like "bytes 100-199/1000"
+#
+
+def parse_content_range(header):
+	try:
+		unit, _, spec = header.strip().partition(' ')
+		byte_range, _, size = spec.partition('/')
+		return int(byte_range.partition('-')[0]), int(size)
+	except ValueError:
+		raise CorruptDownloadException("Invalid Content-Range %s." % header)
+
 class JSONHTTPRequest(HTTPRequest):
 
 	content_type = 'application/json'
@@ -247,3 +646,65 @@ class JSONHTTPRequest(HTTPRequest):
 	@data.setter
 	def data(self, data):
 		self._data = json.dumps(data)
+
+#
+# file_checksum(filename)
+#
+# Returns the SHA-256 of a file, as hex, reading it in chunks
+#
+
+def file_checksum(filename):
+	checksum = hashlib.sha256()
+	with open(filename, "rb") as fp:
+		for chunk in iter(lambda: fp.read(CHUNK_SIZE), ""):
+			checksum.update(chunk)
+	return checksum.hexdigest()
+
+#
+# UploadException
+#
+
+class UploadException(Exception):
+	pass
+
+#
+# UploadTooLargeException
+#
+
+class UploadTooLargeException(UploadException):
+	pass
+
+#
+# IncompleteUploadException
+#
+
+class IncompleteUploadException(UploadException):
+	pass
+
+#
+# ChecksumMismatchException
+#
+
+class ChecksumMismatchException(UploadException):
+	pass
+
+#
+# DownloadException
+#
+
+class DownloadException(Exception):
+	pass
+
+#
+# IncompleteDownloadException
+#
+
+class IncompleteDownloadException(DownloadException):
+	pass
+
+#
+# CorruptDownloadException
+#
+
+class CorruptDownloadException(DownloadException):
+	pass
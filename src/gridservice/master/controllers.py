@@ -1,38 +1,31 @@
 import os
 import time
+import json
 
 import gridservice.utils
 import gridservice.master.model as model
 
 from gridservice import http
 from gridservice.utils import validate_request
-from gridservice.http import require_json, authenticate, FileResponse, JSONResponse
-from gridservice.master.grid import NodeNotFoundException, JobNotFoundException, InvalidSchedulerException, InvalidJobParameterException
+from gridservice.http import require_json, authenticate, FileResponse, JSONResponse, RawJSONResponse
+from gridservice.http import UploadException, UploadTooLargeException
+from gridservice.master.grid import NodeNotFoundException, JobNotFoundException, WorkUnitNotFoundException, InvalidSchedulerException, InvalidJobParameterException
 from gridservice.master.scheduler import NodeUnavailableException
+from gridservice.master.versioned import json_list, json_object, json_extend
 
 #
 # Authentication Decorators.
 #
+# The set of users each accepts is built once, at import.
+#
 
-def auth_any(func):
-	def decorator_func(*args, **kwargs):
-		return authenticate(model.ADMINS + model.CLIENTS + model.NODES)(func)(*args, **kwargs)
-	return decorator_func
+auth_any = authenticate(model.ADMINS + model.CLIENTS + model.NODES)
 
-def auth_admin(func):
-	def decorator_func(*args, **kwargs):
-		return authenticate(model.ADMINS)(func)(*args, **kwargs)
-	return decorator_func
+auth_admin = authenticate(model.ADMINS)
 
-def auth_client(func):
-	def decorator_func(*args, **kwargs):
-		return authenticate(model.ADMINS + model.CLIENTS)(func)(*args, **kwargs)
-	return decorator_func
+auth_client = authenticate(model.ADMINS + model.CLIENTS)
 
-def auth_node(func):
-	def decorator_func(*args, **kwargs):
-		return authenticate(model.ADMINS + model.NODES)(func)(*args, **kwargs)
-	return decorator_func
+auth_node = authenticate(model.ADMINS + model.NODES)
 
 #
 # scheduler_PUT
@@ -59,21 +52,98 @@ def scheduler_PUT(request):
 	
 	return JSONResponse({ 'success': 'Scheduler changed.' }, http.OK)
 
+#
+# get_job_filters(request)
+#
+# Returns the job filters given in the query string of the 
+# request, as keyword arguments for JobStore.query:
+#
+#     ?status=<status>, may be given more than once
+#     ?job_type=<job_type>
+#     ?name=<name>
+#     ?created_after=<timestamp>&created_before=<timestamp>
+#
+# Raises ValueError if a timestamp is not a number.
+#
+
+def get_job_filters(request):
+	query = request.query
+	filters = {}
+
+	if 'status' in query:
+		filters['statuses'] = query['status']
+
+	for key in [ 'job_type', 'name' ]:
+		if key in query:
+			filters[ key ] = query[ key ][0]
+
+	for key in [ 'created_after', 'created_before' ]:
+		if key in query:
+			filters[ key ] = int(query[ key ][0])
+
+	return filters
+
+#
+# get_page(request)
+#
+# Returns the ?offset= and ?limit= of the request. Raises
+# ValueError if either is not a positive number.
+#
+
+def get_page(request):
+	query = request.query
+
+	offset = int(query.get('offset', [ 0 ])[0])
+	limit = query.get('limit')
+	if limit is not None:
+		limit = int(limit[0])
+
+	if offset < 0 or (limit is not None and limit < 0):
+		raise ValueError("offset and limit must be positive")
+
+	return offset, limit
+
+#
+# is_summary(request)
+#
+# Whether the request asked for jobs without their work units
+# with ?summary=1
+#
+
+def is_summary(request):
+	return request.query.get('summary', [ '0' ])[0] in [ '1', 'true' ]
+
 #
 # job_GET(request)
 #
-# Returns a list of all jobs
+# Returns a list of all jobs. 
+#
+# The jobs may be filtered as in get_job_filters and paged with 
+# ?offset= and ?limit=. Given ?summary=1 the jobs are returned 
+# without their work units.
 #
 
 @auth_client
 def job_GET(request):	
-	jobs = model.grid.jobs
-	
-	safe_jobs = {}
-	for key, job in jobs.items():
-		safe_jobs.update({ key: job.to_dict() })
-	
-	return JSONResponse(safe_jobs, http.OK)
+	try:
+		filters = get_job_filters(request)
+		offset, limit = get_page(request)
+	except ValueError:
+		return JSONResponse({ 'error_msg': 'Invalid job query received.' }, http.BAD_REQUEST)
+
+	if filters or offset or limit is not None:
+		total, jobs = model.grid.jobs.query(offset = offset, limit = limit, **filters)
+	else:
+		jobs = model.grid.jobs.values()
+
+	if is_summary(request):
+		return RawJSONResponse(json_object( 
+			(job.job_id, job.to_summary_json()) for job in jobs 
+		), http.OK)
+
+	return RawJSONResponse(json_object( 
+		(job.job_id, job.to_json()) for job in jobs 
+	), http.OK)
 
 #
 # job_POST(request)
@@ -109,7 +179,9 @@ def job_POST(request):
 #
 # job_id_GET(request, v)
 #
-# Get a job by the id in the URI
+# Get a job by the id in the URI. Given ?unit_status=<status>,
+# which may be given more than once, only the work units with
+# those statuses are returned.
 #
 
 @auth_client
@@ -118,8 +190,14 @@ def job_id_GET(request, v):
 		job = model.grid.get_job(v['id'])
 	except JobNotFoundException as e:
 		return JSONResponse({ 'error_msg': e.args[0] }, http.NOT_FOUND)
+
+	unit_statuses = request.query.get('unit_status')
+	if unit_statuses is not None:
+		return RawJSONResponse(job.to_json_with(
+			unit for unit in job.work_units if unit.status in unit_statuses
+		), http.OK)
 	
-	return JSONResponse(job.to_dict(), http.OK)
+	return RawJSONResponse(job.to_json(), http.OK)
 
 #
 # job_id_DELETE(request, v)
@@ -163,7 +241,7 @@ def job_status_PUT(request, v):
 	except InvalidJobParameterException as e:
 		return JSONResponse({ 'error_msg': e.args[0] }, http.BAD_REQUEST)
 
-	return JSONResponse(job.to_dict(), http.OK)
+	return RawJSONResponse(job.to_json(), http.OK)
 
 #
 # job_output_files_GET(request, v)
@@ -225,7 +303,7 @@ def job_output_file_GET(request, v):
 		return JSONResponse({ 'error_msg': "Unable to open file %s for Job %s; File does not exist" 
 								% (v['file_name'], v['id'])}, http.BAD_REQUEST)
 
-	return FileResponse(file_path)
+	return FileResponse(file_path, request = request)
 
 #
 # job_files_GET(request, v)
@@ -249,7 +327,14 @@ def job_files_GET(request, v):
 	else:
 		return JSONResponse({ 'error_msg': "Invalid file type." }, http.BAD_REQUEST)
 
-	return FileResponse(file_path)
+	response = FileResponse(file_path, request = request)
+
+	# Let the node check what it downloads
+	checksum = job.checksum(v['type'], v['path'])
+	if checksum is not None and response.status in [ http.OK, http.PARTIAL_CONTENT ]:
+		response.add_headers([ (http.CHECKSUM_HEADER, checksum) ])
+
+	return response
 
 #
 # job_files_PUT(request, v)
@@ -275,15 +360,33 @@ def job_files_PUT(request, v):
 		return JSONResponse({ 'error_msg': "Invalid file type." }, http.BAD_REQUEST)
 
 	job.create_file_path(file_path)
-	request.raw_to_file(file_path)
+	checksum, error = save_upload(request, file_path)
+	if error is not None:
+		return error
 	
 	if v['type'] == "executable":
-		job.add_executable(v['path'])
+		job.add_executable(v['path'], checksum)
 	else:
-		job.add_file(v['path'])
+		job.add_file(v['path'], checksum)
 	
 	return JSONResponse(v)
 
+#
+# save_upload(request, file_path)
+#
+# Streams the body of the request to file_path. Returns the 
+# SHA-256 of the file and None, or None and an error response 
+# if the upload was rejected.
+#
+
+def save_upload(request, file_path):
+	try:
+		return request.raw_to_file(file_path, model.MAX_UPLOAD_SIZE), None
+	except UploadTooLargeException as e:
+		return None, JSONResponse({ 'error_msg': e.args[0] }, http.REQUEST_ENTITY_TOO_LARGE)
+	except UploadException as e:
+		return None, JSONResponse({ 'error_msg': e.args[0] }, http.BAD_REQUEST)
+
 #
 # job_workunit_POST(request, v)
 # 
@@ -293,19 +396,39 @@ def job_files_PUT(request, v):
 @require_json
 @auth_node
 def job_workunit_POST(request, v):
-	if not validate_request(request.json, ['work_unit_id', 'kill_msg']): 
+	d = request.json
+	if not validate_request(d, ['work_unit_id', 'node_id', 'task_id', 'kill_msg']): 
 		return JSONResponse({ 'error_msg': 'Invalid Work Unit JSON received.' }, http.BAD_REQUEST)
 
 	try:
 		job = model.grid.get_job(v['id'])
-	except JobNotFoundException as e:
+		unit = model.grid.finish_work_unit(job, d['work_unit_id'], 
+			d['node_id'], d['task_id'], d['kill_msg'])
+	except (JobNotFoundException, WorkUnitNotFoundException) as e:
 		return JSONResponse({ 'error_msg': e.args[0] }, http.NOT_FOUND)
 
-	unit = model.grid.finish_work_unit(job, request.json['work_unit_id'])
-	
-	if request.json['kill_msg'] != None:
-		unit.kill_msg = request.json['kill_msg']
-		unit.kill()
+	return JSONResponse(unit.to_dict(), http.OK)
+
+#
+# job_workunit_requeue_POST(request, v)
+# 
+# Called by a node which could not stage the files of a
+# work unit, so the work unit can be run elsewhere.
+#
+
+@require_json
+@auth_node
+def job_workunit_requeue_POST(request, v):
+	d = request.json
+	if not validate_request(d, ['work_unit_id', 'node_id', 'task_id', 'error_msg']): 
+		return JSONResponse({ 'error_msg': 'Invalid Work Unit JSON received.' }, http.BAD_REQUEST)
+
+	try:
+		job = model.grid.get_job(v['id'])
+		unit = model.grid.requeue_work_unit(job, d['work_unit_id'], 
+			d['node_id'], d['task_id'], d['error_msg'])
+	except (JobNotFoundException, WorkUnitNotFoundException) as e:
+		return JSONResponse({ 'error_msg': e.args[0] }, http.NOT_FOUND)
 
 	return JSONResponse(unit.to_dict(), http.OK)
 
@@ -317,13 +440,11 @@ def job_workunit_POST(request, v):
 
 @auth_client
 def node_GET(request):
-	nodes = model.grid.nodes
+	nodes = model.grid.nodes.items()
 
-	safe_nodes = {}
-	for key, node in nodes.items():
-		safe_nodes.update({ key: model.grid.node_to_dict(node) })
-	
-	return JSONResponse(safe_nodes, http.OK)
+	return RawJSONResponse(json_object( 
+		(key, node.to_json()) for key, node in nodes 
+	), http.OK)
 
 #
 # node_POST(request)
@@ -356,12 +477,13 @@ def node_id_GET(request, v):
 	except NodeNotFoundException as e:
 		return JSONResponse({ 'error_msg': e.args[0] }, http.NOT_FOUND)
 
-	return JSONResponse(model.grid.node_to_dict(node), http.OK)
+	return RawJSONResponse(node.to_json(), http.OK)
 
 #
 # node_id_POST(request, v)
 #
-# Updates the node at the given URI, returns the node
+# Updates the node at the given URI, returns the node with
+# the files it should prefetch
 #
 
 @require_json
@@ -375,7 +497,10 @@ def node_id_POST(request, v):
 	except NodeNotFoundException as e:
 		return JSONResponse({ 'error_msg': e.args[0] }, http.NOT_FOUND)
 
-	return JSONResponse(model.grid.node_to_dict(node), http.OK)
+	# Let the node fetch the files it is likely to need next
+	hints = model.grid.get_prefetch_hints(node)
+
+	return RawJSONResponse(json_extend(node.to_json(), 'prefetch', json.dumps(hints)), http.OK)
 
 #
 # Routes related to console function
@@ -389,7 +514,7 @@ def node_id_POST(request, v):
 
 @auth_client
 def index_GET(request):
-	return FileResponse(os.path.join("www", "console/console.html"))
+	return FileResponse(os.path.join("www", "console/console.html"), request = request)
 
 #
 # file_GET(request, v)
@@ -399,85 +524,210 @@ def index_GET(request):
 
 @auth_client
 def file_GET(request, v):
-	return FileResponse(os.path.join("www", v["file"]))
+	return FileResponse(os.path.join("www", v["file"]), request = request)
+
+
+#
+# get_since(request)
+#
+# Returns the ?since= cursor of the request, or None if there
+# is none. Raises ValueError if the cursor is not a number.
+#
 
+def get_since(request):
+	since = request.query.get('since')
+	if since is None:
+		return None
+	return int(since[0])
 
 # 
 # Duplicate of nodes_GET
 #
 # Returns a list isntead of a dictionary.
 #
+# Given ?since=<cursor>, returns only the nodes which have 
+# changed since the cursor, including nodes which have died.
+# The cursor to pass next time is returned in either case.
+#
 
 @auth_client
 def nodes_GET(request):
-	nodeList = model.grid.nodes.values()
+	try:
+		since = get_since(request)
+	except ValueError:
+		return JSONResponse({ 'error_msg': 'Invalid cursor received.' }, http.BAD_REQUEST)
+
+	if since is None:
+		cursor = model.grid.changes.cursor()
+		nodeList = [ node for node in model.grid.nodes.values() if node.status != "DEAD" ]
+	else:
+		cursor, nodeList = model.grid.changes.changed_nodes(since)
 
 	jsonNodes = []
 	for node in nodeList:
-		try:
-			cpu = node['cpu']
-		except KeyError:
-			cpu = 0
-		if  node['status'] != "DEAD":
-			n = {
-				"host": node['host'],
-				"port": node['port'],
-				"node_id": node['node_id'],
-				"status": node['status'],
-				"work_units": [],
-				"type": node['type'],
-				"node_ident": node['node_ident'],
-				"cores": node['cores'],
-				"cpu": cpu,
-				"cost": node['cost']
-			}
-			for unit in node["work_units"]:
-				n["work_units"].append(unit.to_dict())
-			
-			jsonNodes.append(n)
-
-	return  JSONResponse({ 'nodes': jsonNodes}, 200)
+		jsonNodes.append(node.to_console_json())
+
+	return  RawJSONResponse(json_object([ 
+		('nodes', json_list(jsonNodes)), 
+		('cursor', str(cursor)) 
+	]), 200)
 
 #
 # Duplicate of job_GET
 #
 # Returns a list of jobs on The Grid.
 #
+# Given ?since=<cursor>, returns only the jobs which have changed
+# since the cursor, with only their work units which have changed.
+# The cursor to pass next time is returned in either case.
+#
+# The jobs may be filtered as in get_job_filters. Without a cursor
+# they may also be paged with ?offset= and ?limit=, and the total
+# number of jobs matching the filters is returned.
+#
 
 @auth_client
 def jobs_GET(request):
-	queued_jobs = model.grid.get_queued()
-	queued_jobs = model.grid.jobs
+	try:
+		since = get_since(request)
+		filters = get_job_filters(request)
+		offset, limit = get_page(request)
+	except ValueError:
+		return JSONResponse({ 'error_msg': 'Invalid job query received.' }, http.BAD_REQUEST)
 
 	ljobs=[]
-	for j in queued_jobs.values():
-		ljobs.append(j.to_dict())
-
+	if since is None:
+		cursor = model.grid.changes.cursor()
+		total, jobs = model.grid.jobs.query(offset = offset, limit = limit, **filters)
+		for j in jobs:
+			ljobs.append(j.to_json())
+	else:
+		cursor, changed_jobs = model.grid.changes.changed_jobs(since)
+		for j in changed_jobs:
+			if model.grid.jobs.matches(j, **filters):
+				ljobs.append(j.to_delta_json(since))
+		total = len(ljobs)
 
-	return  JSONResponse({ 'jobs': ljobs}, 200)
+	return  RawJSONResponse(json_object([ 
+		('jobs', json_list(ljobs)), 
+		('cursor', str(cursor)),
+		('total', str(total)),
+	]), 200)
 
 
 #
 # log_GET(request)
 #
-# Returns the updated portion of the Scheduler Log since
-# the last call to log_GET
+# Returns the last lines of the Scheduler Log, or given
+# ?after=<id> the lines after the line with that id. The id 
+# to pass next time is returned as the cursor.
 #
 
 @auth_client
 def log_GET(request):
+	try:
+		after = request.query.get('after')
+		if after is not None:
+			after = int(after[0])
+	except ValueError:
+		return JSONResponse({ 'error_msg': 'Invalid cursor received.' }, http.BAD_REQUEST)
+
+	logs = get_logs(model.grid.log, after)
+	return  JSONResponse({ 'log': logs, 'cursor': log_cursor(logs, after) }, 200)
+
+#
+# get_logs(log, after = None)
+#
+# Returns the last lines of the log, or only those after
+# the line with id after.
+#
+
+def get_logs(log, after = None):
 
 	# We also want to track an "id" so that we can make UI updates
 	# more efficiently (so we don't redraw stuff thats already drawn)
-	start = len(model.grid.scheduler.mem_log)-100
-	if start < 0:
-		start=0
-
 	logs=[]
-	for i in xrange(start, len(model.grid.scheduler.mem_log)):
-		logs.append( { "id": i, "log": model.grid.scheduler.mem_log[i]})
+	for i, line in log.get_lines(after):
+		logs.append( { "id": i, "log": line})
+
+	return logs
+
+#
+# log_cursor(logs, after)
+#
+# The cursor to pass to get the lines after the given lines
+#
+
+def log_cursor(logs, after):
+	if logs:
+		return logs[-1]['id']
+	elif after is not None:
+		return after
+	return -1
+
+#
+# stream_GET(request)
+#
+# A long poll of the jobs, nodes and scheduler log of The Grid,
+# for the console.
+#
+# Without a cursor, returns the jobs, live nodes and recent log
+# at once. Given ?since=<cursor>&log=<log id> from a previous 
+# response, waits up to STREAM_TIMEOUT seconds for something to
+# change, and returns only the jobs, work units and nodes which
+# have changed since the cursor, and the log lines after the 
+# log id. The cursor and log id to pass next time are returned
+# in either case.
+#
+
+STREAM_TIMEOUT = 20
+
+# The least time a stream request takes to return a change, so a
+# burst of changes goes out in one reply rather than one each
+STREAM_BATCH_INTERVAL = 1
+
+@auth_client
+def stream_GET(request):
+	try:
+		since = get_since(request)
+		log_after = request.query.get('log')
+		if log_after is not None:
+			log_after = int(log_after[0])
+	except ValueError:
+		return JSONResponse({ 'error_msg': 'Invalid cursor received.' }, http.BAD_REQUEST)
+
+	log = model.grid.log
+	changes = model.grid.changes
+
+	if since is None:
+		cursor = changes.cursor()
+		jobs = [ job.to_json() for job in model.grid.jobs.values() ]
+		nodes = [ node.to_console_json() for node in model.grid.nodes.values() if node.status != "DEAD" ]
+	else:
+		start = time.time()
+
+		def ready():
+			return (changes.has_changed(since) or 
+				(log_after is not None and log.last_id > log_after))
+		if changes.wait(ready, STREAM_TIMEOUT):
+			# Let the rest of the burst catch up
+			remaining = start + STREAM_BATCH_INTERVAL - time.time()
+			if remaining > 0:
+				time.sleep(remaining)
+
+		cursor, changed_jobs, changed_nodes = changes.changes(since)
+		jobs = [ job.to_delta_json(since) for job in changed_jobs ]
+		nodes = [ node.to_console_json() for node in changed_nodes ]
+
+	logs = get_logs(log, log_after)
 
-	return  JSONResponse({ 'log': logs}, 200)
+	return RawJSONResponse(json_object([
+		('jobs', json_list(jobs)),
+		('nodes', json_list(nodes)),
+		('log', json.dumps(logs)),
+		('cursor', str(cursor)),
+		('log_cursor', str(log_cursor(logs, log_after))),
+	]), http.OK)
 
 #
 # Duplicate of job_files_PUT
@@ -495,9 +745,11 @@ def job_submit_file_POST(request, v):
 	file_path = job.input_path(file_name)
 
 	job.create_file_path(file_path)
-	request.raw_to_file(file_path)
+	checksum, error = save_upload(request, file_path)
+	if error is not None:
+		return error
 
-	job.add_file(file_name)
+	job.add_file(file_name, checksum)
 
 	return JSONResponse( {'tmp_job_id': v['tmp_job_id'], 'filename': file_path} , 200)
 
@@ -517,8 +769,10 @@ def job_submit_executable_POST(request, v):
 	file_path = job.executable_path(file_name)
 	
 	job.create_file_path(file_path)
-	request.raw_to_file(file_path)
+	checksum, error = save_upload(request, file_path)
+	if error is not None:
+		return error
 
-	job.add_executable(file_name)
+	job.add_executable(file_name, checksum)
 
 	return JSONResponse( {'tmp_job_id': v['tmp_job_id'], 'filename': file_path} , 200)
@@ -0,0 +1,146 @@
+import threading
+import sys
+import traceback
+from collections import defaultdict, deque, OrderedDict
+
+#
+# Dispatcher
+#
+# A bounded pool of threads which sends work units to the nodes
+# they have been allocated to, so that the work unit allocator
+# never has to wait on the network while it holds the queue lock.
+#
+# dispatch(node, work_unit) is called on one of the pool's threads
+# for each work unit submitted, and wake() once it has returned.
+# Any number of work units can be submitted for a node, but at most
+# MAX_NODE_DISPATCHES of the pool's threads send to any one node at
+# once, so a slow node cannot tie up the whole pool. Nodes take
+# turns, so a node given many work units doesn't hold up the rest.
+#
+# If dispatch raises, the error is passed to failed(node, work_unit,
+# error_msg) so the work unit can be put back in the queue, and the
+# thread carries on.
+#
+
+class Dispatcher(object):
+
+	THREADS = 8
+
+	MAX_NODE_DISPATCHES = 4
+
+	def __init__(self, dispatch, wake, failed, threads = THREADS,
+		max_node_dispatches = MAX_NODE_DISPATCHES):
+
+		self.dispatch = dispatch
+		self.wake = wake
+		self.failed = failed
+
+		self.num_threads = threads
+		self.max_node_dispatches = max_node_dispatches
+
+		self.threads = []
+		self.stopping = False
+
+		# node_id -> deque of (node, work_unit) waiting to be sent,
+		# in the order the nodes take turns
+		self.pending = OrderedDict()
+
+		# node_id -> number of work units being sent to the node
+		self.in_flight = defaultdict(int)
+
+		self.lock = threading.Lock()
+		self.condition = threading.Condition(self.lock)
+
+	#
+	# start(self)
+	#
+	# Starts the dispatch threads
+	#
+
+	def start(self):
+		for i in range(0, self.num_threads):
+			thread = threading.Thread(target = self.worker)
+			thread.name = "Master:Grid:Scheduler:Dispatcher:%d" % i
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	#
+	# stop(self)
+	#
+	# Stops the dispatch threads once they have sent the work
+	# units already submitted
+	#
+
+	def stop(self):
+		with self.lock:
+			self.stopping = True
+			self.condition.notify_all()
+
+	#
+	# submit(self, node, work_unit)
+	#
+	# Queues the work unit to be sent to the node
+	#
+
+	def submit(self, node, work_unit):
+		with self.lock:
+			if node.node_id not in self.pending:
+				self.pending[ node.node_id ] = deque()
+			self.pending[ node.node_id ].append((node, work_unit))
+
+			self.condition.notify()
+
+	#
+	# next_dispatch(self)
+	#
+	# Takes the next work unit to send, from the first node with
+	# fewer than max_node_dispatches in flight, and moves that node
+	# to the back of the turns. Returns None if there is nothing
+	# which can be sent. Must be called with the lock held.
+	#
+
+	def next_dispatch(self):
+		for node_id, units in self.pending.iteritems():
+			if self.in_flight[ node_id ] >= self.max_node_dispatches:
+				continue
+
+			item = units.popleft()
+			del self.pending[ node_id ]
+			if units:
+				self.pending[ node_id ] = units
+
+			self.in_flight[ node_id ] += 1
+			return item
+
+		return None
+
+	def worker(self):
+		while True:
+			with self.lock:
+				item = self.next_dispatch()
+				while item is None:
+					if self.stopping and not self.pending:
+						return
+
+					self.condition.wait()
+					item = self.next_dispatch()
+
+			node, work_unit = item
+			try:
+				self.dispatch(node, work_unit)
+			except Exception as e:
+				exc_type, exc_value, exc_tb = sys.exc_info()
+				self.failed(node, work_unit,
+					"".join(traceback.format_exception(exc_type, exc_value, exc_tb)))
+			finally:
+				with self.lock:
+					self.in_flight[ node.node_id ] -= 1
+					if self.in_flight[ node.node_id ] <= 0:
+						del self.in_flight[ node.node_id ]
+
+					# Another of the node's work units can be sent
+					self.condition.notify()
+
+				# The node can take more work units
+				self.wake()
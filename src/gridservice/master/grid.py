@@ -2,9 +2,10 @@ from __future__ import division
 import threading
 import time 
 import json
-import copy
 import shutil
 import os
+import heapq
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from urllib2 import HTTPError, URLError
@@ -16,6 +17,11 @@ import gridservice.walltime as walltime
 
 from gridservice.master.scheduler import RoundRobinScheduler, FCFSScheduler, DeadlineScheduler, DeadlineCostScheduler, PriorityQueueScheduler
 from gridservice.master.job import Job
+from gridservice.master.node import Node
+from gridservice.master.readyqueue import ReadyQueue
+from gridservice.master.versioned import ChangeLog
+from gridservice.master.jobstore import JobStore
+from gridservice.master.schedulerlog import SchedulerLog, WARNING
 
 #
 # The Grid.
@@ -34,6 +40,21 @@ class Grid(object):
 	
 	NODE_TIMEOUT = 10
 
+	# How often the node reaper looks for nodes that have timed out
+	NODE_SWEEP_INTERVAL = 1
+
+	# The number of times a work unit's files can fail to be staged
+	# on a node before it is killed
+	MAX_STAGING_FAILURES = 3
+
+	# The number of queued work units per core whose files a node
+	# is told to prefetch
+	PREFETCH_UNITS_PER_CORE = 1
+
+	# The most queued work units looked at for the prefetch hints
+	# of each group of nodes
+	PREFETCH_MAX_UNITS = 256
+
 	SCHEDULERS = {
 		'RoundRobin': RoundRobinScheduler,
 		'FCFS': FCFSScheduler,
@@ -43,18 +64,26 @@ class Grid(object):
 	}
 
 	#
-	# __init__(self, scheduler_func)
+	# __init__(self, username, password, scheduler, log = None)
 	#
-	# Initialises The Grid using the given Scheduler
+	# Initialises The Grid using the given Scheduler. The schedulers
+	# write to the given SchedulerLog, or to scheduler_log.txt.
 	#
 
-	def __init__(self, username, password, scheduler):
-		self.jobs = {}
-		self.next_job_id = 0
-		
+	def __init__(self, username, password, scheduler, log = None):
 		self.nodes = {}
 		self.node_ids = {}
 
+		# node_type -> cost -> OrderedDict of node_id -> node, for 
+		# each ONLINE node with at least one core free.
+		self.free_nodes = {}
+		self.free_node_keys = {}
+
+		# Heap of (timeout_ts, node_id) with one entry per ONLINE node,
+		# giving the earliest each node could time out.
+		self.node_timeouts = []
+		self.node_timeout_ids = set()
+
 		self.auth_header = auth_header(username, password)
 
 		# (Proportion of nodes, max wall_time (hours), list of nodes)
@@ -66,8 +95,31 @@ class Grid(object):
 
 		self.next_node_id = 0
 
+		# Bumped whenever a node joins or leaves, or changes its
+		# cores or cost
+		self.nodes_version = 0
+
+		# The groups of nodes given prefetch hints from the same 
+		# work units, and the work units hinted at for each group,
+		# cached until the nodes or the queue change
+		self.prefetch_groups = None
+		self.prefetch_groups_key = None
+		self.prefetch_units = {}
+		self.prefetch_units_key = None
+
 		self.queue_lock = threading.Lock()
-		self.queue = []
+		self.queue = ReadyQueue()
+
+		# The order jobs and nodes have changed in
+		self.changes = ChangeLog()
+
+		self.jobs = JobStore(self.changes)
+
+		# Wake anyone streaming the log when it is written to
+		if log is None:
+			log = SchedulerLog("scheduler_log.txt")
+		log.on_write = self.changes.notify
+		self.log = log
 
 		# Remove all job related files
 		path = os.path.join('www', 'jobs')
@@ -77,6 +129,9 @@ class Grid(object):
 		# Start the scheduler
 		self.scheduler = scheduler
 
+		# Start the node reaper
+		self.start_node_reaper()
+
 	@property
 	def scheduler(self):
 		return self._scheduler
@@ -151,19 +206,18 @@ class Grid(object):
 		# All tests passed, add to grid.
 		#
 
-		job = Job(
-			job_id = self.next_job_id,
+		job = self.jobs.create(lambda job_id: Job(
+			job_id = job_id,
 			flags = flags, 
 			wall_time = wall_stripped, 
 			deadline = deadline_since_epoch, 
 			budget = budget,
 			job_type = job_type,
 			name = name
-		)
-
+		))
 
-		self.jobs[ self.next_job_id ] = job
-		self.next_job_id += 1
+		job.change_log = self.changes
+		job.changed()
 
 		return job
 
@@ -191,15 +245,27 @@ class Grid(object):
 
 	def kill_job(self, job):
 		for unit in job.work_units:
-			if unit.status == "RUNNING":
-				try:
-					node = self.nodes[ unit.node_id ]
-					url = '%s/task/%s' % (self.get_node_url(node), unit.task_id)
-					request = JSONHTTPRequest( 'DELETE', url, "", self.auth_header )
-				except (HTTPException, URLError) as e:
-					print "The node at %s is unavailable. Couldn't kill work unit." % self.get_node_url(node)
-
-		job.kill()
+			# Work units still being sent to their node have no task
+			# yet, the scheduler kills these once they have been sent.
+			if unit.status == "RUNNING" and unit.task_id is not None:
+				self.kill_task(self.nodes[ unit.node_id ], unit.task_id)
+
+		with self.queue_lock:
+			job.kill()
+			self.queue.remove_job(job)
+	
+	#
+	# kill_task(self, node, task_id)
+	#
+	# Tells the node to kill the given task
+	#
+
+	def kill_task(self, node, task_id):
+		try:
+			url = '%s/task/%s' % (node.url, task_id)
+			request = JSONHTTPRequest( 'DELETE', url, "", self.auth_header )
+		except (HTTPException, URLError) as e:
+			print "The node at %s is unavailable. Couldn't kill work unit." % node.url
 	
 	#
 	# update_job_status(self, job_id, status)
@@ -228,52 +294,149 @@ class Grid(object):
 	def add_to_queue(self, job):
 		with self.queue_lock:
 			for work_unit in job.work_units:
-				self.queue.append(work_unit)
+				self.queue.push(work_unit)
+
+		self.scheduler.wake()
+
 	#
-	# finish_work_unit(self, job, work_unit_id)
+	# finish_work_unit(self, job, work_unit_id, node_id, task_id, kill_msg = None)
 	#
-	# Finishes the work unit and removes it from The Grid's internal
-	# state of the Node it was running on.
+	# Called when a node reports a work unit has finished, or was
+	# killed with kill_msg. Frees the core on the node and marks
+	# the work unit as FINISHED or KILLED, unless it has already
+	# been killed. Reports for a work unit which is no longer on
+	# the reporting node, e.g. as the node timed out and it was
+	# requeued, are ignored.
 	#
 
-	def finish_work_unit(self, job, work_unit_id):
-		unit = job.finish_work_unit(work_unit_id)
-		node = self.nodes[ unit.node_id ]
-		for key, work_unit in enumerate(node['work_units']):
-			if work_unit == unit:
-				del node['work_units'][ key ]
+	def finish_work_unit(self, job, work_unit_id, node_id, task_id, kill_msg = None):
+		with self.queue_lock:
+			unit = job.get_work_unit(work_unit_id)
+			if unit is None:
+				raise WorkUnitNotFoundException("There is no work unit with the id: %s" % work_unit_id)
+
+			if not self.remove_node_work_unit(unit, node_id, task_id):
+				return unit
+
+			# The work unit should not be queued, but make sure it
+			# can't be allocated again
+			self.queue.remove(unit)
+
+			if unit.status == "RUNNING":
+				if kill_msg is not None:
+					unit.kill_msg = kill_msg
+					unit.kill()
+				else:
+					unit.finished()
+
+		# A core has been freed
+		self.scheduler.wake()
+
+		return unit
+
+	#
+	# remove_node_work_unit(self, unit, node_id, task_id)
+	#
+	# Frees the core a work unit has on the node, whatever the
+	# work unit's status. Returns False if the work unit is not
+	# on the node, or has since been given another task on it.
+	# Must be called with the queue lock held.
+	#
+
+	def remove_node_work_unit(self, unit, node_id, task_id):
+		node = self.nodes.get(node_id)
+		if node is None or unit.node_id != node_id or unit.task_id not in [ None, task_id ]:
+			return False
+
+		if not node.remove_work_unit(unit):
+			return False
+
+		self.update_free_node(node)
+		return True
+
+	#
+	# requeue_work_unit(self, job, work_unit_id, node_id, task_id, error_msg)
+	#
+	# Called when a node could not stage the files of a work unit.
+	# Frees the core on the node and queues the work unit again, or
+	# kills it once it has failed to stage MAX_STAGING_FAILURES times.
+	# The core is freed whatever the work unit's status, but reports 
+	# for a work unit no longer on the node are ignored.
+	#
+
+	def requeue_work_unit(self, job, work_unit_id, node_id, task_id, error_msg):
+		with self.queue_lock:
+			unit = job.get_work_unit(work_unit_id)
+			if unit is None:
+				raise WorkUnitNotFoundException("There is no work unit with the id: %s" % work_unit_id)
+
+			if not self.remove_node_work_unit(unit, node_id, task_id):
+				return unit
+
+			# The work unit may have been killed while it was staged
+			if unit.status == "RUNNING":
+				unit.staging_failures += 1
+				self.scheduler.write_to_log("Work unit %s of job %s could not be staged on node %s: %s\n" 
+					% (unit.work_unit_id, job.job_id, node_id, error_msg), WARNING)
+
+				if unit.staging_failures >= self.MAX_STAGING_FAILURES:
+					unit.kill_msg = error_msg
+					unit.kill()
+				else:
+					unit.reset()
+					self.queue.push(unit)
+
+		self.scheduler.wake()
 
 		return unit
 
 	#
 	# add_node(self, node)
 	#
-	# Takes a dict containing at minimum a host and port,
-	# calculates a unique ID for the host/port if it hasn't
-	# seen it before, and returns that ID
+	# Takes a dict containing a host, port, cores, programs 
+	# and cost, calculates a unique ID for the host/port if 
+	# it hasn't seen it before, and returns that ID
 	#
 
 	def add_node(self, node):
 		node_ident = "%s:%s" % (node['host'], node['port'])
 
 		if node_ident not in self.node_ids:
-			node.update({'created_ts': int(time.time())})
 			self.node_ids[ node_ident ] = self.next_node_id
 			self.next_node_id += 1
-		
-		node.update({'came_online_ts': int(time.time()), 'heartbeat_ts': int(time.time())})
 
 		node_id = self.get_node_id(node_ident)
 
-		node['node_id'] = node_id
-		node['status'] = "ONLINE"
-		node['work_units'] = []
-		node['type'] = self.get_node_type(node_id)
-		node['node_ident']=node_ident
-
-		self.add_to_node_queues(node_id, node['type'])
-
-		self.nodes[ node_id ] = node
+		with self.queue_lock:
+			# Keep the time the node was first seen if it has re-registered
+			created_ts = None
+			if node_id in self.nodes:
+				created_ts = self.nodes[ node_id ].created_ts
+
+			node_type = self.get_node_type(node_id)
+			self.add_to_node_queues(node_id, node_type)
+
+			node = Node(
+				node_id = node_id,
+				host = node['host'],
+				port = node['port'],
+				cores = node['cores'],
+				programs = node['programs'],
+				cost = node['cost'],
+				node_type = node_type,
+				created_ts = created_ts
+			)
+
+			self.nodes[ node_id ] = node
+			self.nodes_version += 1
+			self.update_free_node(node)
+
+			node.change_log = self.changes
+			node.changed()
+			self.watch_node_timeout(node)
+
+		# New cores are available
+		self.scheduler.wake()
 
 		return node_id
 
@@ -281,7 +444,7 @@ class Grid(object):
 	# get_node(self, node_id)
 	#
 	# Takes a node_is either as an internal id, or as 
-	# the string HOST:PORT and returns the node as a dict
+	# the string HOST:PORT and returns the Node
 	#
 
 	def get_node(self, node_id):
@@ -317,7 +480,7 @@ class Grid(object):
 	#
 
 	def get_node_ident(self, node):
-		return "%s:%s" % (node['host'], node['port'])
+		return node.node_ident
 
 	#
 	# get_node_url(self, node)
@@ -326,7 +489,7 @@ class Grid(object):
 	#
 
 	def get_node_url(self, node):
-		return "http://%s" % (self.get_node_ident(node))
+		return node.url
 
 	#
 	# get_node_type(self, node_id)
@@ -385,28 +548,161 @@ class Grid(object):
 	# update_node(self, node_id, update)
 	#
 	# Takes a node_id and a dict with an update
-	# and updates the node dict with the given
+	# and updates the Node with the given. The update 
+	# is taken with the queue lock held, as the node reaper 
+	# and scheduler read the node from their own threads.
 	#
 
 	def update_node(self, node_id, update):
 		update.update({'heartbeat_ts': int(time.time())})
 
-		self.get_node(node_id).update(update)
-		return self.get_node(node_id)
+		node = self.get_node(node_id)
+		with self.queue_lock:
+			resources = (node.cores, node.cost)
+			node.update(update)
+			if (node.cores, node.cost) != resources:
+				self.nodes_version += 1
+
+			self.update_free_node(node)
+
+		return node
 
 	#
-	# get_queued(self)
+	# get_prefetch_hints(self, node)
 	#
-	# A generator of all queued work units
-	# 
+	# Returns the executables and input files of the work units the
+	# node is likely to run next, as dicts of job_id, type, filename 
+	# and checksum, so the node can fetch them before it is sent 
+	# the work units. Only files whose checksum is known are 
+	# included, since nodes cache files by checksum.
+	#
+
+	def get_prefetch_hints(self, node):
+		with self.queue_lock:
+			units = self.get_prefetch_units(node)
+
+		hints = OrderedDict()
+		for unit in units:
+			job = unit.job
+			files = [
+				("executable", job.executable, job.executable_checksum),
+				("files", unit.filename, job.checksum("files", unit.filename)),
+			]
+
+			for file_type, filename, checksum in files:
+				if filename and checksum is not None and checksum not in hints:
+					hints[ checksum ] = {
+						'job_id': job.job_id,
+						'type': file_type,
+						'filename': filename,
+						'checksum': checksum,
+					}
+
+		return hints.values()
+
+	#
+	# get_prefetch_units(self, node)
+	#
+	# Returns the queued work units the node is likely to run next.
+	#
+	# Nodes with the same prefetch key are given work units from the
+	# same order of jobs, cheapest nodes first, as the allocator 
+	# goes through them. Each node is told about the work units at 
+	# its place in that order, one per core per PREFETCH_UNITS_PER_CORE,
+	# up to PREFETCH_MAX_UNITS for the group.
+	#
+	# The groups are only worked out again once the nodes change, 
+	# and the work units of a group once the queue changes, so 
+	# heartbeats cost no more than a lookup while nothing changes. 
+	# Must be called with the queue lock held.
+	#
+
+	def get_prefetch_units(self, node):
+		if node.status != "ONLINE":
+			return []
+
+		groups_key = (self.scheduler, self.nodes_version)
+		if self.prefetch_groups_key != groups_key:
+			self.prefetch_groups = self.group_prefetch_nodes()
+			self.prefetch_groups_key = groups_key
+
+		group_key = self.scheduler.prefetch_key(node)
+		offsets, count = self.prefetch_groups.get(group_key, ({}, 0))
+		if node.node_id not in offsets:
+			return []
 
-	def get_queued(self):
-		return [unit for unit in self.queue if unit.status == "QUEUED"]
+		units_key = (self.scheduler, self.nodes_version, self.queue.version)
+		if self.prefetch_units_key != units_key:
+			self.prefetch_units = {}
+			self.prefetch_units_key = units_key
+
+		units = self.prefetch_units.get(group_key)
+		if units is None:
+			units = self.scheduler.peek_work_units(node, count)
+			self.prefetch_units[ group_key ] = units
+
+		start = offsets[ node.node_id ]
+		return units[ start:start + node.cores * self.PREFETCH_UNITS_PER_CORE ]
+
+	#
+	# group_prefetch_nodes(self)
+	#
+	# Groups the ONLINE nodes by their prefetch key, returning a dict
+	# of prefetch key -> (dict of node_id -> offset of the node's
+	# work units, number of work units for the group). Nodes beyond
+	# PREFETCH_MAX_UNITS of their group are left out.
+	#
+
+	def group_prefetch_nodes(self):
+		nodes = [ node for node in self.nodes.itervalues() if node.status == "ONLINE" ]
+		nodes.sort(key = lambda node: (node.cost, node.node_id))
+
+		groups = {}
+		for node in nodes:
+			group_key = self.scheduler.prefetch_key(node)
+			offsets, count = groups.get(group_key, ({}, 0))
+			if count >= self.PREFETCH_MAX_UNITS:
+				continue
+
+			offsets[ node.node_id ] = count
+			count = min(count + node.cores * self.PREFETCH_UNITS_PER_CORE, self.PREFETCH_MAX_UNITS)
+			groups[ group_key ] = (offsets, count)
+
+		return groups
+
+	#
+	# update_free_node(self, node)
+	#
+	# Adds or removes the node from the index of free nodes, 
+	# depending on whether it is ONLINE with at least one core 
+	# free. Must be called with the queue lock held whenever a
+	# node's status or work units change.
+	#
+
+	def update_free_node(self, node):
+		node_id = node.node_id
+
+		key = self.free_node_keys.pop(node_id, None)
+		if key is not None:
+			node_type, cost = key
+			nodes = self.free_nodes[ node_type ][ cost ]
+			del nodes[ node_id ]
+
+			if not nodes:
+				del self.free_nodes[ node_type ][ cost ]
+			if not self.free_nodes[ node_type ]:
+				del self.free_nodes[ node_type ]
+
+		if node.is_free:
+			key = (node.type, node.cost)
+			self.free_nodes.setdefault(node.type, {}).setdefault(node.cost, OrderedDict())[ node_id ] = node
+			self.free_node_keys[ node_id ] = key
 
 	#
 	# get_free_node
 	#
-	# A generator of node that have at least 1 core free.
+	# A generator of node that have at least 1 core free, cheapest
+	# nodes first.
 	# If given a node_type will return only nodes of the specified type.
 	# If there are no nodes registered with the specified type will return
 	# a free DEFAULT node.
@@ -414,72 +710,121 @@ class Grid(object):
 
 	def get_free_node(self, node_type=None):
 
-		self.remove_timed_out_nodes()
-			
-		# Get the list of nodes to check
+		# Get the node types to check
 		if node_type is None:
-			node_list = self.nodes.values()
+			node_types = self.free_nodes.keys()
 		elif node_type in self.node_queue.keys():
-			node_ids = self.node_queue[node_type][2]
-
 			# If there's no nodes in that queue assign to the DEFAULT queue
-			if len(node_ids) is 0:
-				node_ids = self.node_queue["DEFAULT"][2]
-
-			# Recover nodes from node_ids list:
-			node_list = []
-			for node_id in node_ids:
-				node_list.append(self.nodes[node_id])
+			if len(self.node_queue[node_type][2]) is 0:
+				node_type = "DEFAULT"
+			node_types = [ node_type ]
 		else:
 			raise InvalidNodeTypeException("%s is not a valid priority queue type.\n" % node_type)
 
-		# Check for node with at least 1 core free
+		# Take a copy of the free nodes, as they will fill up as
+		# work units are allocated to them.
+		buckets = []
+		for node_type in node_types:
+			buckets.extend(self.free_nodes.get(node_type, {}).items())
+		buckets.sort(key = lambda bucket: bucket[0])
+
+		node_list = []
+		for cost, nodes in buckets:
+			node_list.extend(nodes.values())
+
+		# Check the node still has at least 1 core free
 		for node in node_list:
-			if node['status'] == "ONLINE" and (node['cores'] - len(node['work_units']) > 0):
+			if node.is_free:
 				yield node
 
+	#
+	# mark_node_dead(self, node)
+	#
+	# Marks the node as DEAD, removes it from the node queues
+	# and from the free node index, and requeues its orphaned
+	# work units. Must be called with the queue lock held.
+	#
+
+	def mark_node_dead(self, node):
+		node.status = "DEAD"
+		self.nodes_version += 1
+		self.update_free_node(node)
+
+		# Remove the node_id from the node queues
+		self.remove_from_node_queues(node.node_id)
+
+		# Requeue orphaned work units
+		for unit in node.clear_work_units():
+			if unit.status == "RUNNING":
+				unit.reset()
+				self.queue.push(unit)
+
+		self.scheduler.wake()
+
+	#
+	# watch_node_timeout(self, node)
+	#
+	# Starts watching an ONLINE node for a missed heartbeat
+	#
+
+	def watch_node_timeout(self, node):
+		if node.node_id not in self.node_timeout_ids:
+			self.node_timeout_ids.add(node.node_id)
+			heapq.heappush(self.node_timeouts, 
+				(node.heartbeat_ts + self.NODE_TIMEOUT, node.node_id))
+
 	# 
 	# remove_timed_out_nodes(self)
 	#
 	# Looks for nodes that have not had their heartbeat within
-	# NODE_TIMEOUT and removes them from the nodes list and the 
-	# different node queues.
+	# NODE_TIMEOUT, marks them as DEAD and requeues their 
+	# orphaned work units.
+	#
+	# Only nodes at the top of the timeout heap are looked at.
+	# Their heartbeat may have moved on since they were pushed,
+	# in which case they are pushed back with their new timeout.
+	# Must be called with the queue lock held.
 	#
 	
 	def remove_timed_out_nodes(self):
-		for node_id, node in list(self.nodes.items()):
-			if node['status'] == "ONLINE" and node['heartbeat_ts'] + self.NODE_TIMEOUT < int(time.time()):
-				print "Node %s has timed out." % (self.get_node_ident(node))
+		now = int(time.time())
 
-				# Remove the node by setting status to DEAD
-				node['status'] = "DEAD"
+		while self.node_timeouts and self.node_timeouts[0][0] < now:
+			timeout_ts, node_id = heapq.heappop(self.node_timeouts)
+			self.node_timeout_ids.discard(node_id)
 
-				# Remove the node_id from the node queues
-				self.remove_from_node_queues(node_id)
+			node = self.nodes[ node_id ]
+			if node.status != "ONLINE":
+				continue
 
-				# Requeue orphaned work units
-				for unit in node['work_units']:
+			if node.heartbeat_ts + self.NODE_TIMEOUT >= now:
+				self.watch_node_timeout(node)
+				continue
 
-					if unit.status == "RUNNING":
-						unit.reset()
-						self.queue.append(unit)
+			print "Node %s has timed out." % (node.node_ident)
+
+			# Remove the node by setting status to DEAD, and
+			# requeue its work units
+			self.mark_node_dead(node)
 
 	#
-	# node_to_dict(self, node)
+	# start_node_reaper(self)
 	#
-	# For some stupid reason Nodes are still not an object,
-	# but are a dict, so we need some fancy converting to
-	# output a node nicely.
+	# Starts a thread which removes timed out nodes every
+	# NODE_SWEEP_INTERVAL seconds
 	#
 
-	def node_to_dict(self, node):
-		n = copy.copy(node)
-
-		n['work_units'] = []
-		for unit in node['work_units']:
-			n['work_units'].append(unit.to_dict())
+	def start_node_reaper(self):
+		self.node_reaper = threading.Thread(target = self.node_reaper_loop)
+		self.node_reaper.name = "Master:Grid:NodeReaper"
+		self.node_reaper.daemon = True
+		self.node_reaper.start()
 
-		return n
+	def node_reaper_loop(self):
+		while True:
+			with self.queue_lock:
+				self.remove_timed_out_nodes()
+			time.sleep(self.NODE_SWEEP_INTERVAL)
 
 
 #
@@ -511,6 +856,13 @@ class JobNotFoundException(Exception):
 	pass
 
 
+#
+# WorkUnitNotFoundException
+#
+
+class WorkUnitNotFoundException(Exception):
+	pass
+
 #
 # InvalidJobParameterException
 #
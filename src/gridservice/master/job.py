@@ -4,6 +4,7 @@ import time
 import json
 
 import gridservice.walltime as walltime
+from gridservice.master.versioned import Versioned, json_list, json_extend
 
 #
 # Job
@@ -16,10 +17,36 @@ import gridservice.walltime as walltime
 # RUNNING = Job has at least one work unit being run
 # FINISHED = Job has all work units finished
 #
+# The job keeps a count of its work units in each status, kept up
+# to date by the work units themselves, so checking whether a job
+# has finished does not need to look at every work unit.
+#
+# A job's JSON is cached until the job or one of its work units 
+# changes. Work units keep their own JSON, so only the work units
+# which have changed are encoded again.
+#
+
+class Job(Versioned):
 
-class Job(object):
+	__slots__ = [
+		'job_id', 'status', 'wall_time', 'deadline', 'flags', 'budget',
+		'job_type', 'name', 'kill_msg', 'created_ts', 'ready_ts', 
+		'running_ts', 'finished_ts', 'executable', 'files', 'work_units',
+		'work_unit_ids', 'status_counts', 'units_version', 'change_log',
+		'executable_checksum', 'file_checksums'
+	]
+
+	UNVERSIONED = Versioned.UNVERSIONED | frozenset([ 'units_version', 'change_log' ])
 
 	def __init__(self, job_id, flags, wall_time, deadline, budget, job_type, name):
+		Versioned.__init__(self)
+
+		# The ChangeLog of The Grid, once the job has been added to it
+		self.change_log = None
+
+		# Bumped whenever one of the job's work units changes
+		self.units_version = 0
+
 		self.job_id = job_id
 		self.status = "PENDING"
 		self.wall_time = wall_time
@@ -39,6 +66,17 @@ class Job(object):
 		self.files = []
 		self.work_units = []
 
+		# The SHA-256 of the executable and of each input file, 
+		# so nodes can tell whether they already have them
+		self.executable_checksum = None
+		self.file_checksums = {}
+
+		# work_unit_id -> WorkUnit
+		self.work_unit_ids = {}
+
+		# status -> number of work units with that status
+		self.status_counts = {}
+
 	#
 	# @property budget_per_node_hour(self)
 	# 
@@ -99,15 +137,31 @@ class Job(object):
 		return self.status == "RUNNING"
 
 	def is_finished(self):
+		return self.num_done == self.num_work_units
 
-		# Assume the job is finished. Look for contradiction.
-		finished = True
-		for work_unit in self.work_units:
-			if work_unit.status != "FINISHED" and work_unit.status != "KILLED":
-				finished = False
-				break
+	#
+	# Work Unit Status Counts
+	#
 
-		return finished
+	def count_status(self, status):
+		return self.status_counts.get(status, 0)
+
+	@property
+	def num_done(self):
+		return self.count_status("FINISHED") + self.count_status("KILLED")
+
+	#
+	# work_unit_status_changed(self, old_status, new_status)
+	#
+	# Called by a work unit whenever its status changes
+	#
+
+	def work_unit_status_changed(self, old_status, new_status):
+		if old_status is not None:
+			self.status_counts[ old_status ] -= 1
+			if not self.status_counts[ old_status ]:
+				del self.status_counts[ old_status ]
+		self.status_counts[ new_status ] = self.status_counts.get(new_status, 0) + 1
 
 	#
 	# Filepath operations
@@ -120,8 +174,9 @@ class Job(object):
 	def executable_path(self, executable):
 		return os.path.join(self.executable_dir, executable)
 
-	def add_executable(self, executable):
+	def add_executable(self, executable, checksum = None):
 		self.executable = executable
+		self.executable_checksum = checksum
 	
 	@property
 	def input_dir(self):
@@ -145,8 +200,24 @@ class Job(object):
 		if not os.path.exists(dir_path):
 			os.makedirs(dir_path)
 
-	def add_file(self, filename):
+	def add_file(self, filename, checksum = None):
 		self.files.append(filename)
+		self.file_checksums[ filename ] = checksum
+		self.changed()
+
+	#
+	# checksum(self, file_type, filename)
+	#
+	# The SHA-256 of the job's executable or input file with the
+	# given name, or None if it isn't known
+	#
+
+	def checksum(self, file_type, filename):
+		if file_type == "executable":
+			return self.executable_checksum if filename == self.executable else None
+		elif file_type == "files":
+			return self.file_checksums.get(filename)
+		return None
 
 	#
 	# Creation and Destruction
@@ -155,22 +226,55 @@ class Job(object):
 	def create_work_units(self):
 		if self.files:
 			for i, filename in enumerate(self.files):
-				self.work_units.append( WorkUnit(i, self, filename) )
+				self.add_work_unit( WorkUnit(i, self, filename) )
 		else:
-			self.work_units.append( WorkUnit(0, self) )
+			self.add_work_unit( WorkUnit(0, self) )
+
+	def add_work_unit(self, unit):
+		self.work_units.append(unit)
+		self.work_unit_ids[ unit.work_unit_id ] = unit
+
+		# budget_per_node_hour depends on the number of work units
+		self.changed()
+
+	def changed(self):
+		Versioned.changed(self)
+
+		if self.change_log is not None:
+			self.change_log.job_changed(self)
+
+	def work_unit_changed(self, unit):
+		object.__setattr__(self, 'units_version', self.units_version + 1)
+
+		if self.change_log is not None:
+			self.change_log.work_unit_changed(unit)
+
+	def get_work_unit(self, work_unit_id):
+		return self.work_unit_ids.get(work_unit_id)
 
 	def finish_work_unit(self, work_unit_id):
-		for unit in self.work_units:
-			if unit.work_unit_id == work_unit_id:
-				unit.finished()
-				return unit
+		unit = self.get_work_unit(work_unit_id)
+		if unit is not None:
+			unit.finished()
+		return unit
 
 	#
 	# Representations
 	#
 
 	def to_dict(self):
-		d = {
+		d = self.summary_dict()
+		d['work_units'] = [ work_unit.to_dict() for work_unit in self.work_units ]
+		return d
+
+	#
+	# summary_dict(self)
+	#
+	# The job as a dict, without its work units
+	#
+
+	def summary_dict(self):
+		return {
 			'job_id': self.job_id,
 			'executable': self.executable,
 			'files': self.files,
@@ -187,16 +291,37 @@ class Job(object):
 			'finished_ts': self.finished_ts,
 			'name': self.name,
 			'kill_msg': self.kill_msg,
-			'work_units': [],
+			'work_unit_counts': dict(self.status_counts),
 		}
-
-		for work_unit in self.work_units:
-			d['work_units'].append(work_unit.to_dict())
-		
-		return d
 	
 	def to_json(self):
-		return json.dumps(self.to_dict())
+		return self.cached_json((self.version, self.units_version), self.encode_json)
+
+	def encode_json(self):
+		return self.to_json_with(self.work_units)
+
+	def to_summary_json(self):
+		return json.dumps(self.summary_dict())
+
+	#
+	# to_json_with(self, work_units)
+	#
+	# The job's JSON with only the given work units
+	#
+
+	def to_json_with(self, work_units):
+		return json_extend(self.to_summary_json(), 'work_units', 
+			json_list(work_unit.to_json() for work_unit in work_units))
+
+	#
+	# to_delta_json(self, since)
+	#
+	# The job's JSON with only the work units which have 
+	# changed after the given ChangeLog cursor
+	#
+
+	def to_delta_json(self, since):
+		return self.to_json_with(work_unit for work_unit in self.work_units if work_unit.seq > since)
 
 	def __str__(self):
 		return self.to_json()
@@ -211,9 +336,16 @@ class Job(object):
 # each WorkUnit is to be scheduled independently.
 #
 
-class WorkUnit(object):
+class WorkUnit(Versioned):
+
+	__slots__ = [
+		'job', 'work_unit_id', 'task_id', 'node_id', 'kill_msg', 
+		'_status', 'filename', 'created_ts', 'finished_ts', 'staging_failures'
+	]
 	
 	def __init__(self, work_unit_id, job, filename = None):
+		Versioned.__init__(self)
+
 		self.job = job
 		
 		self.work_unit_id = work_unit_id
@@ -221,15 +353,40 @@ class WorkUnit(object):
 		self.node_id = None
 		self.kill_msg = None
 
+		self._status = None
 		self.status = "QUEUED"
 		self.filename = filename
 		self.created_ts = int(time.time())
 		self.finished_ts = None
 
+		# The number of times nodes could not stage the work unit's files
+		self.staging_failures = 0
+
 	@property
 	def cost(self):
 		return self.job.budget_per_node_hour
 
+	def changed(self):
+		Versioned.changed(self)
+		self.job.work_unit_changed(self)
+
+	#
+	# @property status(self)
+	#
+	# Setting the status keeps the job's work unit status
+	# counts up to date.
+	#
+
+	@property
+	def status(self):
+		return self._status
+
+	@status.setter
+	def status(self, status):
+		if status != self._status:
+			self.job.work_unit_status_changed(self._status, status)
+			self._status = status
+
 	#
 	# Status Setters
 	#
@@ -285,8 +442,16 @@ class WorkUnit(object):
 
 		return d
 
+	#
+	# to_json(self)
+	#
+	# A work unit's JSON also includes fields of its job, so
+	# it is cached against the job's version too.
+	#
+
 	def to_json(self):
-		return json.dumps(self.to_dict())
+		return self.cached_json((self.version, self.job.version), 
+			lambda: json.dumps(self.to_dict()))
 
 	def __str__(self):
 		return self.to_json()
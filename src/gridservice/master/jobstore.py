@@ -0,0 +1,168 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+#
+# JobStore
+#
+# Every job The Grid has seen, by job_id, with secondary indexes
+# by job type, name, status and creation time so that clients can
+# ask for the jobs they want without looking at every other job.
+#
+# Job ids are handed out by the store in order, so the jobs and
+# their creation times are kept in lists indexed by job_id, and
+# the ids in each index stay in order.
+#
+# Jobs change status on the scheduler's threads. Rather than have
+# every status change update the store, the status index catches
+# up from The Grid's ChangeLog whenever it is queried, so it only
+# looks at the jobs which have changed since it was last queried.
+#
+
+class JobStore(object):
+
+	def __init__(self, change_log):
+		self.change_log = change_log
+		self.lock = threading.Lock()
+
+		# Indexed by job_id
+		self.jobs = []
+		self.created = []
+
+		# job_type -> [job_id], name -> [job_id]
+		self.job_types = {}
+		self.names = {}
+
+		# status -> set of job_id, and job_id -> indexed status
+		self.statuses = {}
+		self.job_statuses = {}
+
+		# The ChangeLog cursor the status index is up to date with
+		self.seq = 0
+
+	#
+	# create(self, create_job)
+	#
+	# Calls create_job with the next job_id, adds the job it
+	# returns to the store and returns it.
+	#
+
+	def create(self, create_job):
+		with self.lock:
+			job = create_job(len(self.jobs))
+
+			self.jobs.append(job)
+			self.created.append(job.created_ts)
+			self.job_types.setdefault(job.job_type, []).append(job.job_id)
+			self.names.setdefault(job.name, []).append(job.job_id)
+			self.index_status(job)
+
+		return job
+
+	def index_status(self, job):
+		status = self.job_statuses.get(job.job_id)
+		if status == job.status:
+			return
+
+		if status is not None:
+			self.statuses[ status ].discard(job.job_id)
+
+		self.statuses.setdefault(job.status, set()).add(job.job_id)
+		self.job_statuses[ job.job_id ] = job.status
+
+	#
+	# Dict access by job_id
+	#
+
+	def __len__(self):
+		return len(self.jobs)
+
+	def __contains__(self, job_id):
+		return isinstance(job_id, (int, long)) and 0 <= job_id < len(self.jobs)
+
+	def __getitem__(self, job_id):
+		if job_id not in self:
+			raise KeyError(job_id)
+		return self.jobs[ job_id ]
+
+	def keys(self):
+		return range(len(self.jobs))
+
+	def values(self):
+		return list(self.jobs)
+
+	def items(self):
+		return list(enumerate(self.jobs))
+
+	#
+	# query(self, statuses, job_type, name, created_after, created_before, offset, limit)
+	#
+	# Returns the number of jobs matching the filters, and the
+	# jobs from offset up to limit of them, in job_id order.
+	# Filters which are None are not applied. statuses is a list
+	# of statuses to match any of.
+	#
+
+	def query(self, statuses = None, job_type = None, name = None,
+		created_after = None, created_before = None, offset = 0, limit = None):
+
+		with self.lock:
+			self.update_statuses()
+
+			# Start from the smallest index that applies
+			candidates = [ xrange(
+				bisect_left(self.created, created_after) if created_after is not None else 0,
+				bisect_right(self.created, created_before) if created_before is not None else len(self.created)
+			) ]
+			if job_type is not None:
+				candidates.append(self.job_types.get(job_type, []))
+			if name is not None:
+				candidates.append(self.names.get(name, []))
+			if statuses is not None:
+				ids = set()
+				for status in statuses:
+					ids.update(self.statuses.get(status, ()))
+				candidates.append(sorted(ids))
+
+			job_ids = min(candidates, key = len)
+			jobs = [ self.jobs[ job_id ] for job_id in job_ids ]
+
+		# Check the other filters on the candidates themselves
+		jobs = [ job for job in jobs if self.matches(job,
+			statuses, job_type, name, created_after, created_before) ]
+
+		end = None if limit is None else offset + limit
+		return len(jobs), jobs[ offset:end ]
+
+	#
+	# matches(self, job, statuses, job_type, name, created_after, created_before)
+	#
+	# Whether the job matches the filters of a query
+	#
+
+	def matches(self, job, statuses = None, job_type = None, name = None,
+		created_after = None, created_before = None):
+
+		if statuses is not None and job.status not in statuses:
+			return False
+		if job_type is not None and job.job_type != job_type:
+			return False
+		if name is not None and job.name != name:
+			return False
+		if created_after is not None and job.created_ts < created_after:
+			return False
+		if created_before is not None and job.created_ts > created_before:
+			return False
+		return True
+
+	#
+	# update_statuses(self)
+	#
+	# Brings the status index up to date with the jobs which have
+	# changed since it was last updated. Must be called with the
+	# lock held.
+	#
+
+	def update_statuses(self):
+		self.seq, jobs = self.change_log.changed_jobs(self.seq)
+		for job in jobs:
+			self.index_status(job)
@@ -13,3 +13,8 @@ ADMINS = [
 NODES = [
 	('node', 'node')
 ]
+
+# The largest file, in bytes, which can be uploaded to The Grid,
+# or None for no limit
+
+MAX_UPLOAD_SIZE = None
@@ -0,0 +1,244 @@
+import time
+import json
+from collections import OrderedDict
+
+from gridservice.master.versioned import Versioned, json_list, json_extend
+
+#
+# Node
+#
+# The Grid's view of a Node that has registered with it.
+#
+# ONLINE = Node is sending heartbeats and can be given work units
+# DEAD = Node has timed out or could not be reached
+#
+# The work units allocated to the node are kept by
+# (job_id, work_unit_id), so they can be added and removed in O(1),
+# and the number of free cores is kept up to date as they are.
+#
+# A node's JSON is cached until the node or one of its work units
+# changes. Heartbeats alone aren't logged as changes, as they don't
+# change anything the console shows, and would otherwise wake the
+# console on every heartbeat of every node.
+#
+
+class Node(Versioned):
+
+	__slots__ = [
+		'node_id', 'node_ident', 'host', 'port', 'cores', 'programs',
+		'cost', 'type', 'status', 'cpu', 'created_ts', 'came_online_ts',
+		'heartbeat_ts', 'work_units', 'free_cores', 'console_json_cache',
+		'change_log'
+	]
+
+	UNVERSIONED = Versioned.UNVERSIONED | frozenset([ 'console_json_cache', 'change_log' ])
+
+	# Fields a Node may change with an update
+	UPDATABLE = [ 'cores', 'programs', 'cost', 'cpu', 'heartbeat_ts' ]
+
+	# Fields which change the node's JSON, but aren't logged as 
+	# changes in the ChangeLog
+	UNLOGGED = frozenset([ 'heartbeat_ts' ])
+
+	def __init__(self, node_id, host, port, cores, programs, cost, node_type, created_ts = None):
+		Versioned.__init__(self)
+		self.console_json_cache = None
+
+		# The ChangeLog of The Grid, once the node has been added to it
+		self.change_log = None
+
+		now = int(time.time())
+
+		self.node_id = node_id
+		self.node_ident = "%s:%s" % (host, port)
+		self.host = host
+		self.port = port
+		self.cores = int(cores)
+		self.programs = programs
+		self.cost = cost
+		self.type = node_type
+
+		self.status = "ONLINE"
+		self.cpu = None
+
+		self.created_ts = now if created_ts is None else created_ts
+		self.came_online_ts = now
+		self.heartbeat_ts = now
+
+		# (job_id, work_unit_id) -> WorkUnit
+		self.work_units = OrderedDict()
+		self.free_cores = self.cores
+
+	def __setattr__(self, name, value):
+		if name in self.UNLOGGED:
+			object.__setattr__(self, name, value)
+			Versioned.changed(self)
+		else:
+			Versioned.__setattr__(self, name, value)
+
+	def changed(self):
+		Versioned.changed(self)
+
+		if self.change_log is not None:
+			self.change_log.node_changed(self)
+
+	@property
+	def url(self):
+		return "http://%s" % self.node_ident
+
+	@property
+	def is_free(self):
+		return self.status == "ONLINE" and self.free_cores > 0
+
+	#
+	# update(self, update)
+	#
+	# Updates the node from a dict sent by the node.
+	# Fields which the node may not change are ignored, and 
+	# only fields whose value differs are set, so an update
+	# which changes nothing isn't a change.
+	#
+
+	def update(self, update):
+		for key in self.UPDATABLE:
+			if key in update:
+				value = update[ key ]
+				if key == 'cores':
+					value = int(value)
+
+				if getattr(self, key) != value:
+					setattr(self, key, value)
+
+		free_cores = self.cores - len(self.work_units)
+		if self.free_cores != free_cores:
+			self.free_cores = free_cores
+
+	#
+	# Work Units
+	#
+
+	def add_work_unit(self, unit):
+		key = (unit.job.job_id, unit.work_unit_id)
+		if key not in self.work_units:
+			self.work_units[ key ] = unit
+			self.free_cores -= 1
+
+	#
+	# remove_work_unit(self, unit)
+	#
+	# Removes a work unit from the node. Returns False if the
+	# work unit was not allocated to the node.
+	#
+
+	def remove_work_unit(self, unit):
+		if self.work_units.pop((unit.job.job_id, unit.work_unit_id), None) is None:
+			return False
+
+		self.free_cores += 1
+		return True
+
+	#
+	# clear_work_units(self)
+	#
+	# Removes and returns all of the node's work units
+	#
+
+	def clear_work_units(self):
+		units = self.work_units.values()
+		self.work_units = OrderedDict()
+		self.free_cores = self.cores
+		return units
+
+	#
+	# Representations
+	#
+
+	def to_dict(self):
+		d = self.summary_dict()
+		d['work_units'] = [ unit.to_dict() for unit in self.work_units.itervalues() ]
+		return d
+
+	#
+	# summary_dict(self)
+	#
+	# The node as a dict, without its work units
+	#
+
+	def summary_dict(self):
+		d = {
+			'node_id': self.node_id,
+			'node_ident': self.node_ident,
+			'host': self.host,
+			'port': self.port,
+			'cores': self.cores,
+			'programs': self.programs,
+			'cost': self.cost,
+			'type': self.type,
+			'status': self.status,
+			'created_ts': self.created_ts,
+			'came_online_ts': self.came_online_ts,
+			'heartbeat_ts': self.heartbeat_ts,
+		}
+
+		if self.cpu is not None:
+			d['cpu'] = self.cpu
+
+		return d
+
+	#
+	# console_dict(self)
+	#
+	# The summary of the node shown by the console, 
+	# without its work units
+	#
+
+	def console_dict(self):
+		return {
+			'host': self.host,
+			'port': self.port,
+			'node_id': self.node_id,
+			'status': self.status,
+			'type': self.type,
+			'node_ident': self.node_ident,
+			'cores': self.cores,
+			'cpu': self.cpu if self.cpu is not None else 0,
+			'cost': self.cost,
+		}
+
+	#
+	# json_key(self)
+	#
+	# The key the node's JSON is cached against. A node only
+	# has as many work units as it has cores, so the versions 
+	# of its work units are cheap to check.
+	#
+
+	def json_key(self):
+		return (self.version, tuple(
+			(unit.version, unit.job.version) for unit in self.work_units.itervalues()
+		))
+
+	def encode_json(self, d):
+		return json_extend(json.dumps(d), 'work_units', 
+			json_list(unit.to_json() for unit in self.work_units.itervalues()))
+
+	def to_json(self):
+		return self.cached_json(self.json_key(), 
+			lambda: self.encode_json(self.summary_dict()))
+
+	def to_console_json(self):
+		key = self.json_key()
+
+		cache = self.console_json_cache
+		if cache is not None and cache[0] == key:
+			return cache[1]
+
+		data = self.encode_json(self.console_dict())
+		self.console_json_cache = (key, data)
+		return data
+
+	def __str__(self):
+		return self.node_ident
+
+	def __repr__(self):
+		return "<Node %s %s>" % (self.node_id, self.node_ident)
@@ -0,0 +1,446 @@
+import heapq
+from itertools import islice
+from collections import OrderedDict
+
+#
+# ReadyQueue
+#
+# The queue of work units waiting to be allocated to a Node.
+#
+# Queued work units are grouped by job, and jobs are grouped by
+# job type, so the schedulers can look at the jobs waiting to run
+# without rebuilding a map of jobs from every queued work unit.
+# Work units are removed as soon as they are allocated or killed,
+# so the queue only ever holds QUEUED work units.
+#
+# Enqueuing, dequeuing and removal are all O(1).
+#
+# Listeners (such as a JobIndex) are told whenever a job joins 
+# or leaves the queue, so they can keep their own orderings of 
+# the queued jobs up to date incrementally.
+#
+# version is bumped whenever a work unit joins or leaves the queue,
+# so callers can tell whether the queue has changed since they
+# last looked at it.
+#
+
+class ReadyQueue(object):
+
+	def __init__(self):
+		# job_id -> OrderedDict of work_unit_id -> WorkUnit
+		self.units = {}
+
+		# job_id -> Job, in the order jobs were queued
+		self.jobs = OrderedDict()
+
+		# job_type -> OrderedDict of job_id -> Job
+		self.job_types = {}
+
+		self.length = 0
+		self.version = 0
+
+		self.listeners = []
+
+	def __len__(self):
+		return self.length
+
+	def __iter__(self):
+		for job_id in self.jobs:
+			for unit in self.units[job_id].itervalues():
+				yield unit
+
+	#
+	# push(self, unit)
+	#
+	# Adds a work unit to the end of its job's queue
+	#
+
+	def push(self, unit):
+		job = unit.job
+
+		if job.job_id not in self.units:
+			self.units[ job.job_id ] = OrderedDict()
+			self.jobs[ job.job_id ] = job
+			self.job_types.setdefault(job.job_type, OrderedDict())[ job.job_id ] = job
+
+			for listener in self.listeners:
+				listener.job_queued(job)
+
+		units = self.units[ job.job_id ]
+		if unit.work_unit_id not in units:
+			units[ unit.work_unit_id ] = unit
+			self.length += 1
+			self.version += 1
+
+	#
+	# remove(self, unit)
+	#
+	# Removes a work unit from the queue. Returns False if
+	# the work unit was not queued.
+	#
+
+	def remove(self, unit):
+		units = self.units.get(unit.job.job_id)
+		if units is None or unit.work_unit_id not in units:
+			return False
+
+		del units[ unit.work_unit_id ]
+		self.length -= 1
+		self.version += 1
+
+		if not units:
+			self.remove_job_entry(unit.job)
+
+		return True
+
+	#
+	# remove_job(self, job)
+	#
+	# Removes all of a job's work units from the queue
+	#
+
+	def remove_job(self, job):
+		units = self.units.get(job.job_id)
+		if units is None:
+			return
+
+		self.length -= len(units)
+		self.version += 1
+		self.remove_job_entry(job)
+
+	def remove_job_entry(self, job):
+		del self.units[ job.job_id ]
+		del self.jobs[ job.job_id ]
+
+		job_types = self.job_types[ job.job_type ]
+		del job_types[ job.job_id ]
+		if not job_types:
+			del self.job_types[ job.job_type ]
+
+		for listener in self.listeners:
+			listener.job_dequeued(job)
+
+	#
+	# peek(self, job)
+	#
+	# Returns the next work unit of the job, or None if the
+	# job has no queued work units
+	#
+
+	def peek(self, job):
+		units = self.units.get(job.job_id)
+		if not units:
+			return None
+		return units[ next(iter(units)) ]
+
+	#
+	# pop(self, job)
+	#
+	# Removes and returns the next work unit of the job
+	#
+
+	def pop(self, job):
+		unit = self.peek(job)
+		if unit is not None:
+			self.remove(unit)
+		return unit
+
+	#
+	# pop_units(self, job, count)
+	#
+	# Removes and returns up to count of the job's next work units
+	#
+
+	def pop_units(self, job, count):
+		units = []
+		while len(units) < count:
+			unit = self.pop(job)
+			if unit is None:
+				break
+			units.append(unit)
+		return units
+
+	#
+	# Listeners
+	#
+
+	def add_listener(self, listener):
+		self.listeners.append(listener)
+
+	def remove_listener(self, listener):
+		if listener in self.listeners:
+			self.listeners.remove(listener)
+
+	#
+	# Queries
+	#
+
+	def has_job(self, job_id):
+		return job_id in self.units
+
+	def num_queued(self, job):
+		units = self.units.get(job.job_id)
+		if units is None:
+			return 0
+		return len(units)
+
+	def get_units(self, job):
+		units = self.units.get(job.job_id)
+		if units is None:
+			return []
+		return units.values()
+
+	#
+	# peek_units(self, job, count)
+	#
+	# Returns up to count of the job's next work units, 
+	# without removing them from the queue
+	#
+
+	def peek_units(self, job, count):
+		units = self.units.get(job.job_id)
+		if units is None:
+			return []
+		return list(islice(units.itervalues(), count))
+
+	#
+	# get_jobs(self, job_type = None)
+	#
+	# An iterator of the jobs with queued work units, in the
+	# order they were queued. If given a job_type only jobs
+	# of that type are returned.
+	#
+
+	def get_jobs(self, job_type = None):
+		if job_type is None:
+			return self.jobs.itervalues()
+		return self.job_types.get(job_type, {}).itervalues()
+
+#
+# JobIndex
+#
+# An ordering of the jobs in a ReadyQueue, kept up to date as jobs
+# join and leave the queue.
+#
+# Schedulers ask for the best job for a node, which usually depends
+# on the node's type and cost. The index keeps a separate tier of
+# jobs for each (job_type, cost) it is asked about, holding only the
+# jobs of that type whose budget_per_node_hour can afford that cost.
+# A tier is built from the queue the first time it is asked for and 
+# is then maintained incrementally, so a lookup never has to skip
+# over jobs that cannot run on the node.
+#
+# Node costs are set by each node, so there is no limit to how many
+# tiers could be asked for, and every tier has to be updated as jobs
+# join the queue. Only the MAX_TIERS most recently used tiers are
+# kept. The tiers of nodes which are still allocating are used on 
+# every pass, so the tiers dropped are usually those of costs no 
+# live node has any more. They are rebuilt if asked for again.
+#
+# container is a callable returning an empty tier, e.g. a JobHeap.
+#
+
+class JobIndex(object):
+
+	MAX_TIERS = 32
+
+	def __init__(self, queue, container):
+		self.queue = queue
+		self.container = container
+
+		# (job_type, cost) -> tier, least recently used first
+		self.tiers = OrderedDict()
+
+		queue.add_listener(self)
+
+	#
+	# close(self)
+	#
+	# Stops the index from following the queue
+	#
+
+	def close(self):
+		self.queue.remove_listener(self)
+
+	def in_tier(self, job, job_type, cost):
+		if job_type is not None and job.job_type != job_type:
+			return False
+		return cost is None or job.budget_per_node_hour >= cost
+
+	#
+	# ReadyQueue listener
+	#
+
+	def job_queued(self, job):
+		for (job_type, cost), tier in self.tiers.iteritems():
+			if self.in_tier(job, job_type, cost):
+				tier.push(job)
+
+	def job_dequeued(self, job):
+		for tier in self.tiers.itervalues():
+			tier.remove(job)
+
+	#
+	# get_tier(self, job_type = None, cost = None)
+	#
+	# Returns the tier of jobs of the given type that can afford
+	# the given cost, building it if it has not been asked for 
+	# before. None matches any type or cost.
+	#
+
+	def get_tier(self, job_type = None, cost = None):
+		key = (job_type, cost)
+
+		tier = self.tiers.pop(key, None)
+		if tier is None:
+			tier = self.container()
+			for job in self.queue.get_jobs(job_type):
+				if self.in_tier(job, job_type, cost):
+					tier.push(job)
+
+			if len(self.tiers) >= self.MAX_TIERS:
+				self.tiers.popitem(last = False)
+
+		# Most recently used
+		self.tiers[ key ] = tier
+		return tier
+
+	def peek(self, job_type = None, cost = None):
+		return self.get_tier(job_type, cost).peek()
+
+#
+# JobHeap
+#
+# A min-heap of jobs ordered by key(job), with ties broken by job_id.
+#
+# Removed jobs are only marked as removed and are dropped once they
+# reach the top of the heap, so push and remove are O(log n) and 
+# peek is amortised O(1). The heap is compacted if removed entries
+# come to outnumber the live ones.
+#
+# Iterating over the heap gives the jobs in order without changing
+# the heap, and costs O(k log k) for the first k jobs.
+#
+
+class JobHeap(object):
+
+	def __init__(self, key):
+		self.key = key
+		self.heap = []
+
+		# job_id -> heap entry of [key, job_id, job]
+		self.entries = {}
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, job):
+		return job.job_id in self.entries
+
+	#
+	# __iter__(self)
+	#
+	# Walks the heap from the top, keeping the entries whose 
+	# parents have been visited in a second heap, so the next 
+	# job in order is always at the top of it
+	#
+
+	def __iter__(self):
+		heap = self.heap
+		if not heap:
+			return
+
+		frontier = [ (heap[0], 0) ]
+		while frontier:
+			entry, i = heapq.heappop(frontier)
+			if entry[-1] is not None:
+				yield entry[-1]
+
+			for child in (2 * i + 1, 2 * i + 2):
+				if child < len(heap):
+					heapq.heappush(frontier, (heap[child], child))
+
+	def push(self, job):
+		if job.job_id in self.entries:
+			return
+
+		entry = [ self.key(job), job.job_id, job ]
+		self.entries[ job.job_id ] = entry
+		heapq.heappush(self.heap, entry)
+
+	def remove(self, job):
+		entry = self.entries.pop(job.job_id, None)
+		if entry is None:
+			return
+
+		# Mark the entry as removed
+		entry[-1] = None
+
+		if len(self.heap) > 2 * len(self.entries) + 32:
+			self.heap = [ e for e in self.heap if e[-1] is not None ]
+			heapq.heapify(self.heap)
+
+	def peek(self):
+		while self.heap and self.heap[0][-1] is None:
+			heapq.heappop(self.heap)
+
+		if self.heap:
+			return self.heap[0][-1]
+		return None
+
+	def pop(self):
+		job = self.peek()
+		if job is not None:
+			self.remove(job)
+		return job
+
+#
+# JobRotation
+#
+# A round robin rotation of jobs. New jobs join the back of the
+# rotation and a job is moved to the back once it has had its turn.
+# Jobs drop out of the rotation as soon as they leave the queue.
+#
+# Push, remove and rotate are all O(1).
+#
+
+class JobRotation(object):
+
+	def __init__(self):
+		# job_id -> Job, in rotation order
+		self.jobs = OrderedDict()
+
+	def __len__(self):
+		return len(self.jobs)
+
+	def __contains__(self, job):
+		return job.job_id in self.jobs
+
+	def __iter__(self):
+		return self.jobs.itervalues()
+
+	def __str__(self):
+		return str(self.jobs.keys())
+
+	def push(self, job):
+		if job.job_id not in self.jobs:
+			self.jobs[ job.job_id ] = job
+
+	def remove(self, job):
+		self.jobs.pop(job.job_id, None)
+
+	def peek(self):
+		if not self.jobs:
+			return None
+		return self.jobs[ next(iter(self.jobs)) ]
+
+	#
+	# rotate(self, job)
+	#
+	# Moves the job to the back of the rotation
+	#
+
+	def rotate(self, job):
+		if job.job_id in self.jobs:
+			del self.jobs[ job.job_id ]
+			self.jobs[ job.job_id ] = job
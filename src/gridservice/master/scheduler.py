@@ -1,18 +1,62 @@
 from __future__ import division
 import threading
-from collections import defaultdict, deque
 import time
 import sys
 import os
 import traceback
+import socket
+from itertools import islice
 
 from urllib2 import HTTPError, URLError
 from httplib import HTTPException
 
 from gridservice.http import JSONHTTPRequest
 from gridservice.utils import validate_request
+from gridservice.master.readyqueue import JobIndex, JobHeap, JobRotation
+from gridservice.master.dispatcher import Dispatcher
+from gridservice.master.schedulerlog import DEBUG, INFO, ERROR
 import gridservice.walltime as walltime
 
+#
+# latest_start(job)
+#
+# The latest time a job can start and still finish within its 
+# wall time before its deadline.
+#
+
+def latest_start(job):
+	return job.deadline - walltime.wall_secs(job.wall_time)
+
+#
+# deadline_key(job)
+#
+# Orders jobs by earliest latest start time. Where these are the
+# same, the job with the higher budget per node hour goes first.
+#
+
+def deadline_key(job):
+	return (latest_start(job), -job.budget_per_node_hour)
+
+#
+# arrival_key(job)
+#
+# Orders jobs by creation time. created_ts only has one second
+# resolution, so JobHeap breaks ties by the order of job_id.
+#
+
+def arrival_key(job):
+	return job.created_ts
+
+#
+# arrival_cost_key(job)
+#
+# Orders jobs by creation time. Where these are the same, the job
+# with the higher budget per node hour goes first.
+#
+
+def arrival_cost_key(job):
+	return (job.created_ts, -job.budget_per_node_hour)
+
 #
 # Scheduler
 #
@@ -22,10 +66,16 @@ import gridservice.walltime as walltime
 class Scheduler(object):
 	
 	# How often the work unit allocator will try to
-	# allocate new jobs from the queue.
+	# allocate new jobs from the queue if it has not
+	# been woken by an event on The Grid.
 
 	WORK_UNIT_ALLOCATOR_INTERVAL = 2
 
+	# The queue is written to the log at most this often,
+	# and only when it has changed.
+
+	QUEUE_LOG_INTERVAL = 10
+
 	#
 	# ___init___(self, grid)
 	#
@@ -35,11 +85,35 @@ class Scheduler(object):
 	def __init__(self, grid):
 		self.grid = grid
 		self.killed = False
+
+		# Set whenever The Grid changes in a way that might
+		# let more work units be allocated.
+		self.wake_event = threading.Event()
+
+		# Indexes of the ready queue kept by this scheduler
+		self.indexes = []
+
+		# Sends allocated work units to their nodes
+		self.dispatcher = Dispatcher(self.dispatch_work_unit, self.wake, 
+			self.dispatch_failed)
+
+		# Jobs by latest start time, used to find jobs that can
+		# no longer make their deadline.
+		self.deadline_index = self.create_index(lambda: JobHeap(deadline_key))
 		
-		self.mem_log = [];
-		self.log = open("scheduler_log.txt", "a")
+		# The log is kept by The Grid, so it carries on when
+		# the scheduler is changed
+		self.log = grid.log
 		self.write_to_log("Starting Scheduler.\n")
 
+		# The version of the queue when it was last logged
+		self.queue_log_version = None
+		self.queue_log_ts = 0
+
+		# The last waiting message, so it is only logged once
+		# until the allocator stops waiting
+		self.waiting_message = None
+
 	#
 	# start(self)
 	#
@@ -48,6 +122,8 @@ class Scheduler(object):
 
 	def start(self):
 		self.write_to_log("Starting work unit allocator.\n")
+		self.dispatcher.start()
+
 		self.thread = threading.Thread(target = self.work_unit_allocator)
 		self.thread.name = "Master:Grid:Scheduler:WorkUnitAllocator"
 		self.thread.daemon = True
@@ -62,26 +138,58 @@ class Scheduler(object):
 	def stop(self):
 		self.write_to_log("Stopping work unit allocator.\n")
 		self.killed = True
+		self.wake()
 		self.thread.join()
+		self.dispatcher.stop()
+
+		for index in self.indexes:
+			index.close()
+
+	#
+	# create_index(self, container)
+	#
+	# Creates a JobIndex of the ready queue which will be closed
+	# when the scheduler is stopped.
+	#
+
+	def create_index(self, container):
+		index = JobIndex(self.grid.queue, container)
+		self.indexes.append(index)
+		return index
+
+	#
+	# wake(self)
+	#
+	# Wakes the work unit allocator so that it runs an allocation
+	# pass straight away. Called by The Grid when work units are
+	# queued, cores are freed or nodes come and go.
+	#
+
+	def wake(self):
+		self.wake_event.set()
 
 	#
 	# work_unit_allocator(self)
 	#
 	# A infinite loop that attempts to allocate queued jobs
-	# then sleeps to allow more jobs to become available
+	# then waits until it is woken by an event on The Grid, 
+	# polling every WORK_UNIT_ALLOCATOR_INTERVAL as a fallback.
 	#
 
 	def work_unit_allocator(self):
 		self.write_to_log("Work Unit Allocator Started\n")
 		while self.killed == False:
+			# Clear before allocating so any event that arrives
+			# mid-pass triggers another pass straight after.
+			self.wake_event.clear()
 			self.allocate_work_units()
-			time.sleep(self.WORK_UNIT_ALLOCATOR_INTERVAL)
+			self.wake_event.wait(self.WORK_UNIT_ALLOCATOR_INTERVAL)
 
 	#
 	# allocate_work_units(self)
 	#
 	# Loop over the available nodes and allocate work units 
-	# to them based on the next_work_unit function
+	# to them based on the next_work_units function
 	#
 
 	def allocate_work_units(self):
@@ -89,124 +197,348 @@ class Scheduler(object):
 			free_nodes = False
 
 			# Check that there are jobs to schedule
-			if len(self.grid.get_queued()) == 0:
-				self.write_to_log("Waiting for tasks to schedule.\n")
+			if len(self.grid.queue) == 0:
+				self.write_waiting_to_log("Waiting for tasks to schedule.\n")
 				return
 
 			# Write the job queue to the log
 			self.write_queue_to_log()
 
+			# Kill any work_units which have no chance of finishing before the deadline.
+			self.kill_expired_work_units()
 			for node in self.grid.get_free_node():
 				free_nodes = True
 				
-				# Kill any work_units which have no chance of finishing before the deadline.
-				for unit in self.grid.get_queued():
-				 	if (int(time.time()) + walltime.wall_secs(unit.job.wall_time)) > unit.job.deadline:
-				 		unit.kill_msg = "Killed by scheduler: Unable to complete work_unit by deadline."
-				 		unit.kill()
+				# Want to allocate on all free cores on the node in one go
+				free_cores = node.free_cores
 				
-				# Want to allocate on all free cores on the node
-				for free_core in range(0, (node['cores'] - len(node['work_units']))):
-					
-					# Get the next work unit to allocate
-					try:
-						unit = self.next_work_unit(node)
-					except Exception as e:
-						self.write_to_log("Work unit allocator crashed\n")
-						exc_type, exc_value, exc_tb = sys.exc_info()
-						traceback_msg = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
-						self.log.write(traceback_msg)
-						self.log.close()
-						print "Error in Scheduler. Shutting down Server."
-						os._exit(1)
-					
-					if unit == None:
-						continue
-	
-					# Output to log file
-					self.write_to_log("Allocating work unit " + 
-								   str(unit.work_unit_id) + " of job " + 
-								   str(unit.job.job_id) + " on node " + 
-								   str(node['node_id']) + ".\n\n")
-
-					# If allocating the work unit has failed,
-					# we break to avoid death.
-					try:
-						self.allocate_work_unit(node, unit)
-					except NodeUnavailableException as e:
-						self.write_to_log("Failed to allocated job!\n")
-						self.grid.nodes[ node['node_id'] ]['status'] = "DEAD"
+				# Get the next work units to allocate
+				try:
+					units = self.next_work_units(node, free_cores)
+				except Exception as e:
+					self.write_to_log("Work unit allocator crashed\n", ERROR)
+					exc_type, exc_value, exc_tb = sys.exc_info()
+					traceback_msg = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
+					self.log.write(traceback_msg, ERROR)
+					self.log.close()
+					print "Error in Scheduler. Shutting down Server."
+					os._exit(1)
+
+				self.allocate_work_units_to_node(node, units)
 			
 			# Find a cleaner way to do this!
 			if not free_nodes:
-				self.write_to_log("Waiting for free nodes.\n")
+				self.write_waiting_to_log("Waiting for free nodes.\n")
+			else:
+				self.waiting_message = None
+
+
+	#
+	# allocate_work_units_to_node(self, node, units)
+	#
+	# Allocates each of the work units taken from the queue to
+	# the node.
+	#
+
+	def allocate_work_units_to_node(self, node, units):
+		for unit in units:
 
+			# Output to log file
+			self.write_to_log("Allocating work unit " + 
+						   str(unit.work_unit_id) + " of job " + 
+						   str(unit.job.job_id) + " on node " + 
+						   str(node.node_id) + ".\n\n")
+
+			self.allocate_work_unit(node, unit)
 
 	#
 	# allocate_work_unit(self, node, work_unit)
 	#
-	# Allocates the given work_unit to the given node,
-	# send the work unit information to the node, and
-	# then updates the work unit to reflect it is now
-	# running and updates the node.
+	# Allocates the given work_unit to the given node. The 
+	# work unit is marked as running and takes up a core on the
+	# node straight away, and is then sent to the node by the 
+	# dispatcher once the queue lock has been released.
 	#
 
 	def allocate_work_unit(self, node, work_unit):
+		work_unit.running(node.node_id, None)
+		node.add_work_unit(work_unit)
+		self.grid.update_free_node(node)
+
+		self.dispatcher.submit(node, work_unit)
+
+	#
+	# dispatch_work_unit(self, node, work_unit)
+	#
+	# Called by the dispatcher to send the work unit to the node
+	# and record the task id the node gives back. If the node is 
+	# unavailable it is marked as DEAD and its work units, this one
+	# included, are put back in the queue. If the work unit was 
+	# killed or requeued while it was being sent, the node is told
+	# to kill the task.
+	#
+
+	def dispatch_work_unit(self, node, work_unit):
+		try:
+			task_id = self.send_work_unit(node, work_unit)
+		except NodeUnavailableException as e:
+			with self.grid.queue_lock:
+				self.write_to_log("Failed to allocated job!\n")
+
+				# Requeues the work unit, and any others on the node
+				self.grid.mark_node_dead(node)
+			return
+
+		with self.grid.queue_lock:
+			if work_unit.status == "RUNNING" and work_unit.node_id == node.node_id:
+				work_unit.task_id = task_id
+				return
+
+			orphaned = work_unit.status != "FINISHED"
+
+		if orphaned:
+			self.grid.kill_task(node, task_id)
+
+	#
+	# dispatch_failed(self, node, work_unit, error_msg)
+	#
+	# Called by the dispatcher if sending a work unit failed in 
+	# a way dispatch_work_unit doesn't handle. The work unit is put
+	# back in the queue, unless it has moved on since. The core it
+	# took on the node is freed either way.
+	#
+
+	def dispatch_failed(self, node, work_unit, error_msg):
+		with self.grid.queue_lock:
+			self.write_to_log("Failed to send work unit %s of job %s to node %s:\n%s" 
+				% (work_unit.work_unit_id, work_unit.job.job_id, node.node_id, error_msg), ERROR)
+
+			if self.grid.remove_node_work_unit(work_unit, node.node_id, None) and \
+				work_unit.status == "RUNNING":
+				work_unit.reset()
+				self.grid.queue.push(work_unit)
+
+	#
+	# send_work_unit(self, node, work_unit)
+	#
+	# Sends the work unit information to the node and returns
+	# the id of the task the node created for it.
+	#
+
+	def send_work_unit(self, node, work_unit):
 		try:
 			url = '%s/task' % (self.grid.get_node_url(node))
 			request = JSONHTTPRequest( 'POST', url, {
 				'work_unit_id': work_unit.work_unit_id,
 				'job_id': work_unit.job.job_id,
 				'executable': work_unit.job.executable,
+				'executable_checksum': work_unit.job.executable_checksum,
 				'filename': work_unit.filename,
+				'file_checksum': work_unit.job.checksum("files", work_unit.filename),
 				'flags': work_unit.job.flags,
 				'wall_time': walltime.strftime(work_unit.job.wall_time),
 				'deadline': work_unit.job.deadline,
 			}, self.grid.auth_header)
-		except (HTTPException, URLError) as e:
+		except (HTTPException, URLError, socket.error) as e:
 			raise NodeUnavailableException("The node at %s is unavailable." % self.grid.get_node_url(node))
 
-		d = request.response
-		work_unit.running(node['node_id'], d['task_id'])
-		node['work_units'].append(work_unit)
+		return request.response['task_id']
+
+	#
+	# kill_expired_work_units(self)
+	#
+	# Kills the queued work units of any job which has no chance
+	# of finishing before its deadline, and removes them from 
+	# the queue. Expired jobs are always at the top of the 
+	# deadline index, so only they are looked at.
+	#
+
+	def kill_expired_work_units(self):
+		queue = self.grid.queue
+		now = int(time.time())
+
+		job = self.deadline_index.peek()
+		while job is not None and latest_start(job) < now:
+			for unit in queue.get_units(job):
+				unit.kill_msg = "Killed by scheduler: Unable to complete work_unit by deadline."
+				unit.kill()
+			queue.remove_job(job)
+
+			job = self.deadline_index.peek()
 	
 	#
-	# next_work_unit(self, node)
+	# next_work_units(self, node, count)
+	#
+	# Takes up to count work units off the queue to be allocated
+	# to the free cores of the node in a single pass. By default
+	# work units are taken from the job given by next_job until
+	# it runs out, then from the next job, and so on.
+	#
+
+	def next_work_units(self, node, count):
+		return self.take_work_units(count, self.next_job, node)
+
+	#
+	# peek_work_units(self, node, count)
+	#
+	# Returns up to count of the work units next_work_units would
+	# be most likely to give the node, and the nodes after it, in 
+	# the order they would be given out, without taking them off 
+	# the queue. Used to tell nodes which files to prefetch.
+	#
+
+	def peek_work_units(self, node, count):
+		return self.peek_jobs_work_units(self.queued_jobs(node), count)
+
+	#
+	# peek_jobs_work_units(self, jobs, count)
+	#
+	# Returns up to count work units from the given jobs, all of
+	# one job's queued work units before the next job's, as 
+	# take_work_units would take them
+	#
+
+	def peek_jobs_work_units(self, jobs, count):
+		units = []
+		for job in jobs:
+			if len(units) >= count:
+				break
+			units.extend(self.grid.queue.peek_units(job, count - len(units)))
+
+		return units
+
+	#
+	# queued_jobs(self, node)
+	#
+	# An iterator of the queued jobs, in the order next_job
+	# would give them to the node
+	#
+
+	def queued_jobs(self, node):
+		raise NotImplementedError()
+
+	#
+	# prefetch_key(self, node)
+	#
+	# Nodes with the same prefetch key are given work units from
+	# the same order of jobs, so share their prefetch hints. Only 
+	# schedulers which order jobs differently for different nodes 
+	# need to override this.
+	#
+
+	def prefetch_key(self, node):
+		return None
+
+	#
+	# next_job(self, node)
 	# 
 	# This is the workhorse of the scheduler, this function will
-	# look through the list of queued work units and decide what
-	# needs to be allocated next. It returns a dict which is
-	# the node that the work unit is going to be allocated to.
+	# look through the queued jobs and decide which job's work
+	# units need to be allocated next to the given node. 
 	#
 
-	def next_work_unit(self, node):
+	def next_job(self, node):
 		raise NotImplementedError()
 
 	#
-	# self.write_to_log(self, log_string)
+	# take_work_units(self, count, next_job, *args)
+	#
+	# Takes up to count work units off the queue from the jobs
+	# returned by next_job(*args), which is asked again each 
+	# time a job runs out of queued work units.
+	#
+
+	def take_work_units(self, count, next_job, *args):
+		units = []
+		while len(units) < count:
+			job = next_job(*args)
+			if job is None:
+				break
+
+			units.extend(self.grid.queue.pop_units(job, count - len(units)))
+
+		return units
+
+	#
+	# take_round_robin_work_units(self, count, job_rotation)
+	#
+	# Takes up to count work units off the queue, one from each 
+	# job in turn. Each job is moved to the end of the rotation
+	# once it has had its turn.
+	#
+
+	def take_round_robin_work_units(self, count, job_rotation):
+		# Write the job rotation to the log for clarity.
+		if len(job_rotation) > 0 and self.log.is_enabled(DEBUG):
+			self.write_to_log(str(job_rotation), DEBUG)
+
+		units = []
+		while len(units) < count:
+			job = job_rotation.peek()
+			if job is None:
+				break
+
+			job_rotation.rotate(job)
+			units.append(self.grid.queue.pop(job))
+
+		return units
+
+	#
+	# peek_round_robin_work_units(self, count, job_rotation)
+	#
+	# Returns up to count of the work units take_round_robin_work_units
+	# would take, without taking them off the queue
+	#
+
+	def peek_round_robin_work_units(self, count, job_rotation):
+		jobs = list(islice(job_rotation, count))
+		if not jobs:
+			return []
+
+		# Each job gives one work unit per turn of the rotation
+		turns = -(-count // len(jobs))
+		queued = [ self.grid.queue.peek_units(job, turns) for job in jobs ]
+
+		units = []
+		for turn in range(turns):
+			for job_units in queued:
+				if turn < len(job_units):
+					units.append(job_units[ turn ])
+
+		return units[ :count ]
+
+	#
+	# self.write_to_log(self, log_string, level = INFO)
 	#
 	# Write the log_string to the log file with a preceeding timestamp
 	#
-	def write_to_log(self, log_string):
+	def write_to_log(self, log_string, level = INFO):
+		if not self.log.is_enabled(level):
+			return
+
 		lines = log_string.split("\n")
 		blank = " "*27 # Blank space equivalent to space taken by timestamp
 
 		# Write first line with timestamp
-		l = "[%s] %s\n" % (time.asctime(), lines[0])
-
-		# We also wand to keep an in memory version of the log
-		# so that we can easily read the log from the UI without
-		# overloading the disk... (since we query it ever 1s)
-		self.log.write(l)
-		self.mem_log.append(l)
+		log_lines = [ "[%s] %s\n" % (time.asctime(), lines[0]) ]
 
 		# Write following lines with padding 
 		for line in lines[1:-1]:
-			l = "%s%s\n" % (blank, line)
-			self.log.write(l)
-			self.mem_log.append(l)
+			log_lines.append("%s%s\n" % (blank, line))
+
+		self.log.write_lines(log_lines, level)
+
+	#
+	# write_waiting_to_log(self, log_string)
+	#
+	# Writes what the allocator is waiting for to the log, once
+	# rather than on every pass while it waits
+	#
 
-		self.log.flush()
+	def write_waiting_to_log(self, log_string):
+		if log_string != self.waiting_message:
+			self.waiting_message = log_string
+			self.write_to_log(log_string)
 
 	#
 	# write_queue_to_log(self, queue) 
@@ -214,6 +546,9 @@ class Scheduler(object):
 	# Writes out the current queue of jobs with relevant information to the
 	# log file. Useful for determining if schedulers are functioning correctly
 	#
+	# The queue is only written when it has changed since it was last 
+	# written, and at most every QUEUE_LOG_INTERVAL seconds.
+	#
 	# Ex:
 	#   Job: 0
 	#   Type: [DEFAULT | BATCH | FAST]   
@@ -226,36 +561,39 @@ class Scheduler(object):
 	#
 	
 	def write_queue_to_log(self):
-		job_queue = defaultdict(list)
+		queue = self.grid.queue
 
 		# No work units, dont print.
-		if len(self.grid.get_queued()) == 0:
+		if len(queue) == 0:
+			return
+
+		# Unchanged, or written too recently
+		now = time.time()
+		if queue.version == self.queue_log_version or \
+			now - self.queue_log_ts < self.QUEUE_LOG_INTERVAL:
 			return
-			
-		# Build Queue by Job ID
-		for unit in self.grid.get_queued():
-			job_queue[unit.job.job_id].append(unit)
+
+		self.queue_log_version = queue.version
+		self.queue_log_ts = now
 
 		# Print out relevant information for each job
-		queue_string = "Current jobs waiting for allocation:\n"
-		for job_id, units in job_queue.items():
+		parts = [ "Current jobs waiting for allocation:\n" ]
+		for job in queue.get_jobs():
 			# Print information about the job
-			created_ts = time.asctime(time.localtime(units[0].job.created_ts))
-			queue_string += "Job: %s.\n" % (job_id)
-			queue_string += "Type: %s.\n" % (units[0].job.job_type)
-			queue_string += "Creation Time: %s.\n" % (created_ts)
-			queue_string += "Wall Time: %s.\n" % walltime.strftime(units[0].job.wall_time)
-			queue_string += "Deadline: %s.\n" % time.asctime(time.localtime(units[0].job.deadline))
-			queue_string += "Total Budget: $%0.2f.\n" % (units[0].job.budget/100)
-			queue_string += "Budget per node hour: $%0.2f.\n" % (units[0].job.budget_per_node_hour/100)
+			created_ts = time.asctime(time.localtime(job.created_ts))
+			parts.append("Job: %s.\n" % (job.job_id))
+			parts.append("Type: %s.\n" % (job.job_type))
+			parts.append("Creation Time: %s.\n" % (created_ts))
+			parts.append("Wall Time: %s.\n" % walltime.strftime(job.wall_time))
+			parts.append("Deadline: %s.\n" % time.asctime(time.localtime(job.deadline)))
+			parts.append("Total Budget: $%0.2f.\n" % (job.budget/100))
+			parts.append("Budget per node hour: $%0.2f.\n" % (job.budget_per_node_hour/100))
 			# Print out a job's currently queued work units
-			queue_string += "Work Units: ["
-			for unit in units:
-				queue_string += "%s, " % (unit.work_unit_id)
-			queue_string = "%s]\n\n" % (queue_string[0:-2]) # -2 drops the last ", "
+			parts.append("Work Units: [%s]\n\n" % ", ".join(
+				str(unit.work_unit_id) for unit in queue.get_units(job)))
 		
 		# Write out to log
-		self.write_to_log(queue_string)
+		self.write_to_log("".join(parts))
 
 # 
 # RoundRobinScheduler
@@ -271,40 +609,17 @@ class RoundRobinScheduler(Scheduler):
 		print "Using RoundRobin"
 		self.write_to_log("Using Round Robin Scheduler")
 
-		# Use deque, faster than list (no element shifting)
-		self.job_id_queue = deque()
-
-	def next_work_unit(self, node):
-		job_queue = defaultdict(list)
-
-		# Add all the jobs to the queue
-		for unit in self.grid.get_queued():
+		# Jobs join the rotation when they are queued, and drop
+		# out once they have no work units left to queue.
+		self.rotation_index = self.create_index(JobRotation)
 
-			# Add unique job ids to local queue
-			if unit.job.job_id not in self.job_id_queue:
-				self.job_id_queue.append(unit.job.job_id)
+	def next_work_units(self, node, count):
+		# Want to send the first work unit of the first job in the
+		# rotation, then move the job to the end of the rotation.
+		return self.take_round_robin_work_units(count, self.rotation_index.get_tier())
 
-			job_queue[unit.job.job_id].append(unit)
-
-		if len(job_queue) == 0:
-			return None
-
-		# Write job_id_queue to the log for clarity.
-		self.write_to_log(str(self.job_id_queue))
-
-		# Want to send the first work unit of the first job in queue
-		work_unit_to_send = job_queue[self.job_id_queue[0]][0]
-
-		# If its the last work unit of the job we want to remove that job id
-		# from the internal queue.
-		# Otherwise move the job id to the end of the queue
-		if len(job_queue[self.job_id_queue[0]]) == 1:
-			self.job_id_queue.popleft()
-		else:
-			popped_job_id = self.job_id_queue.popleft()
-			self.job_id_queue.append(popped_job_id)
-		
-		return work_unit_to_send
+	def peek_work_units(self, node, count):
+		return self.peek_round_robin_work_units(count, self.rotation_index.get_tier())
 			
 
 
@@ -321,29 +636,15 @@ class FCFSScheduler(Scheduler):
 		print "Using FCFS" # Prints to Server stdout
 		self.write_to_log("Using First Come First Serve Scheduler")
 
-	def next_work_unit(self, node):
-		job_queue = defaultdict(list) 
-
-		for unit in self.grid.get_queued():
-			job_queue[unit.job.job_id].append(unit)
-
-		if len(job_queue) == 0:
-			return None
+		# Jobs in order of arrival
+		self.arrival_index = self.create_index(lambda: JobHeap(arrival_key))
 
+	def next_job(self, node):
 		# Find Job with earliest creation time	
-		
-		# Add 1 second to current time to stop server crashing for jobs
-		# submitted that second.
-		earliest_time = int(time.time()) + 1 
-		earliest_job = None
+		return self.arrival_index.peek()
 
-		for job_id, units in job_queue.items():
-			if units[0].job.created_ts < earliest_time:
-				earliest_time = units[0].job.created_ts
-				earliest_job = job_id
-
-		# Return its first work unit
-		return job_queue[earliest_job][0]
+	def queued_jobs(self, node):
+		return iter(self.arrival_index.get_tier())
 
 
 # 
@@ -360,40 +661,14 @@ class DeadlineScheduler(Scheduler):
 		print "Using Deadline" # Prints to Server stdout
 		self.write_to_log("Using Deadline Scheduler")
 
-	def next_work_unit(self, node):
-		job_queue = defaultdict(list) 
-
-		for unit in self.grid.get_queued():
-			job_queue[unit.job.job_id].append(unit)
-
-		if len(job_queue) == 0:
-			return None
-
-		# Point of differece from FCFS. Have to process
-		# jobs before we can see what the earliest deadline is
-		earliest_deadline = None
-		earliest_job = None
-
-		for job_id, units in job_queue.items():
-		
-			deadline = units[0].job.deadline
-			wall_seconds = walltime.wall_secs(units[0].job.wall_time)
-			time_left = deadline - wall_seconds
-
-			# If we don't have a deadline, assign the
-			# first job's deadline as earliest
-			if earliest_deadline is None:
-				earliest_deadline = time_left
-				earliest_job = job_id
-
-			# Handle case of >1 jobs with varying deadlines
-			#elif deadline < earliest_deadline:
-			elif time_left < earliest_deadline:
-
-				earliest_deadline = time_left
-				earliest_job = job_id
+	def next_job(self, node):
+		# Point of differece from FCFS. The job with the earliest
+		# deadline (less its wall time) is at the top of the 
+		# deadline index.
+		return self.deadline_index.peek()
 
-		return job_queue[earliest_job][0]
+	def queued_jobs(self, node):
+		return iter(self.deadline_index.get_tier())
 
 # 
 # DeadlineCostScheduler
@@ -409,45 +684,18 @@ class DeadlineCostScheduler(Scheduler):
 		print "Using DeadlineCost" # Prints to Server stdout
 		self.write_to_log("Using DeadlineCost Scheduler")
 
-	def next_work_unit(self, node):
-		job_queue = defaultdict(list) 
-			
-		for unit in self.grid.get_queued():
-			job_queue[unit.job.job_id].append(unit)
-
-		if len(job_queue) == 0:
-			return None
-
-		# Get the node's cost from the node JSON
-		node_cost = node['cost']
-		earliest_deadline = None
-		work_unit_to_send = None
-		for job_id, units in job_queue.items():
-			# Check that job runs on node that is within
-			# the job's budget
-			budget_per_node_hour = units[0].job.budget_per_node_hour
-			if budget_per_node_hour >= node_cost:
-		
-				deadline = units[0].job.deadline
-				wall_seconds = walltime.wall_secs(units[0].job.wall_time)
-				time_left = deadline - wall_seconds
-
-				# If we don't have a deadline, assign the
-				# first job's deadline as earliest
-				if earliest_deadline is None:
-					earliest_deadline = time_left
-					work_unit_to_send = job_queue[job_id][0]
+	def next_job(self, node):
+		# Get the node's cost from the node JSON, and find the
+		# job with the earliest deadline that is within budget 
+		# to run on the node. Where the deadlines are the same
+		# the job with the higher budget goes first.
+		return self.deadline_index.peek(cost = node.cost)
 
-				# Handle case of >1 jobs with varying deadlines
-				elif time_left < earliest_deadline:
-					earliest_deadline = time_left
-					work_unit_to_send = job_queue[job_id][0]
+	def queued_jobs(self, node):
+		return iter(self.deadline_index.get_tier(cost = node.cost))
 
-				# Handle case where the deadlines are the same but budgets is higher
-				elif time_left == earliest_deadline and units[0].job.budget_per_node_hour > work_unit_to_send.job.budget_per_node_hour:
-					work_unit_to_send = job_queue[job_id][0]
-
-		return work_unit_to_send
+	def prefetch_key(self, node):
+		return node.cost
 
 
 #
@@ -467,8 +715,11 @@ class PriorityQueueScheduler(Scheduler):
 		print "Using Multi-level Priority Queue Scheduler" # Prints to Server stdout
 		self.write_to_log("Using Multi-level Priority Queue Scheduler")
 		
-		# Need to maintain an internal queue of job ids for round robin.
-		self.job_id_queue = deque()
+		# Need to maintain an internal rotation of jobs for round robin.
+		self.rotation_index = self.create_index(JobRotation)
+
+		# Jobs in order of arrival for FCFS
+		self.arrival_index = self.create_index(lambda: JobHeap(arrival_cost_key))
 	
 	#
 	# allocate_work_units(self)
@@ -481,64 +732,49 @@ class PriorityQueueScheduler(Scheduler):
 	def allocate_work_units(self):
 		with self.grid.queue_lock:
 			# Check that there are jobs to schedule
-			if len(self.grid.get_queued()) == 0:
-				self.write_to_log("Waiting for tasks to schedule.\n")
+			if len(self.grid.queue) == 0:
+				self.write_waiting_to_log("Waiting for tasks to schedule.\n")
 				return
 			
 			# Write the job queue to the log
 			self.write_queue_to_log()
-		
+
+			# Kill any work_units which have no chance of finishing before the deadline.
+			self.kill_expired_work_units()		
+			waiting = []
 			for queue in self.grid.node_queue.keys():
 				free_nodes = False
 				for node in self.grid.get_free_node(queue):
 					free_nodes = True
-				
-					# Kill any work_units which have no chance of finishing before the deadline.
-					for unit in self.grid.get_queued():
-					 	if (int(time.time()) + walltime.wall_secs(unit.job.wall_time)) > unit.job.deadline:
-					 		unit.kill_msg = "Killed by scheduler: Unable to complete work_unit by deadline."
-					 		unit.kill()
-				
 
-					# Want to allocate on all free cores on the node
-					for free_core in range(0, (node['cores'] - len(node['work_units']))):
+					# Want to allocate on all free cores on the node in one go
+					free_cores = node.free_cores
 					
-						# Get the next work unit to allocate
-						try:
-							unit = self.next_work_unit(node, queue)
-						except Exception as e:
-							self.write_to_log("Work unit allocator crashed\n")
-							exc_type, exc_value, exc_tb = sys.exc_info()
-							traceback_msg = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
-							self.log.write(traceback_msg)
-							self.log.close()
-							print "Error in Scheduler. Shutting down Server."
-							os._exit(1)
-				
-						# No work units to allocate for this queue, continue
-						if unit == None:
-							continue
-
-						# Output to log file
-						self.write_to_log("Allocating work unit " + 
-									   str(unit.work_unit_id) + " of job " + 
-									   str(unit.job.job_id) + " on node " + 
-									   str(node['node_id']) + ".\n\n")
-
-						# If allocating the work unit has failed,
-						# we break to avoid death.
-						try:
-							self.allocate_work_unit(node, unit)
-						except NodeUnavailableException as e:
-							self.write_to_log("Failed to allocated job!\n")
-							self.grid.nodes[ node['node_id'] ]['status'] = "DEAD"
+					# Get the next work units to allocate
+					try:
+						units = self.next_work_units(node, free_cores, queue)
+					except Exception as e:
+						self.write_to_log("Work unit allocator crashed\n", ERROR)
+						exc_type, exc_value, exc_tb = sys.exc_info()
+						traceback_msg = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
+						self.log.write(traceback_msg, ERROR)
+						self.log.close()
+						print "Error in Scheduler. Shutting down Server."
+						os._exit(1)
+
+					self.allocate_work_units_to_node(node, units)
 			
 				# Find a cleaner way to do this!
 				if not free_nodes:
-					self.write_to_log("Waiting for free nodes of type %s." % queue)
+					waiting.append(queue)
+
+			if waiting:
+				self.write_waiting_to_log("Waiting for free nodes of type %s." % ", ".join(waiting))
+			else:
+				self.waiting_message = None
 
 	#
-	# next_work_unit(self, node, queue_type)
+	# next_work_units(self, node, count, queue_type)
 	#
 	# Scheduling alogirthm varies by queue. Due to the way The Grid
 	# manages state and dynamically switches scheduler, these all 
@@ -546,149 +782,73 @@ class PriorityQueueScheduler(Scheduler):
 	# the addition of cost constrains for FCFS and Round Robin.
 	#
 	
-	def next_work_unit(self, node, queue_type):
+	def next_work_units(self, node, count, queue_type):
 		# Use Cost constrained FCFS scheduler (good throughput)
 		if queue_type == "BATCH":
-			return self.next_FCFS_work_unit(node)
+			return self.take_work_units(count, self.next_FCFS_job, node)
 
 		# Use Cost constrained earliest deadline scheduler
 		elif queue_type == "DEFAULT":
-			return self.next_deadline_work_unit(node)
+			return self.take_work_units(count, self.next_deadline_job, node)
 			
 		# Use Cost Constrained RoundRobin scheduler (good response time)			
 		elif queue_type == "FAST":
-			return self.next_round_robin_work_unit(node)
+			return self.next_round_robin_work_units(node, count)
+
+		return []
+
+	def peek_work_units(self, node, count):
+		if node.type == "BATCH":
+			jobs = self.arrival_index.get_tier(node.type, node.cost)
+			return self.peek_jobs_work_units(iter(jobs), count)
+
+		elif node.type == "DEFAULT":
+			jobs = self.deadline_index.get_tier(node.type, node.cost)
+			return self.peek_jobs_work_units(iter(jobs), count)
+
+		elif node.type == "FAST":
+			job_rotation = self.rotation_index.get_tier(node.type, node.cost)
+			return self.peek_round_robin_work_units(count, job_rotation)
+
+		return []
+
+	def prefetch_key(self, node):
+		return (node.type, node.cost)
 	
 	#
-	# next_FCFS_work_unit(self, node)
+	# next_FCFS_job(self, node)
 	#
-	# Same as FCFSScheduler(Scheduler).next_work_unit(node)
+	# Same as FCFSScheduler(Scheduler).next_job(node)
 	# but will not assign jobs to nodes they do not have budget for.
 	# 
 
-	def next_FCFS_work_unit(self, node):
-		job_queue = defaultdict(list) 
-
-		for unit in self.grid.get_queued():
-			# Only want jobs of the specified type in the queue.
-			if unit.job.job_type == node['type']:
-				job_queue[unit.job.job_id].append(unit)
-
-		# No jobs to schedule of this type!
-		if len(job_queue) == 0:
-			return None
-
-		# Find Job with earliest creation time	
-		
-		# Add 1 second to current time to stop server crashing for jobs
-		# submitted that second.
-		earliest_time = int(time.time()) + 1 
-		work_unit_to_send = None
-		for job_id, units in job_queue.items():
-			if units[0].job.budget_per_node_hour >= node['cost']:
-				if units[0].job.created_ts < earliest_time:
-					earliest_time = units[0].job.created_ts
-					work_unit_to_send = job_queue[job_id][0]
-				
-				# Handle case where the deadlines are the same but budgets is higher
-				elif (units[0].job.created_ts == earliest_time and 
-						units[0].job.budget_per_node_hour > work_unit_to_send.job.budget_per_node_hour):
-					work_unit_to_send = job_queue[job_id][0]
-		
-		return work_unit_to_send
+	def next_FCFS_job(self, node):
+		# Find Job of the node's type with earliest creation time,
+		# skipping any jobs which cannot afford the node. Where the
+		# creation times are the same the higher budget goes first.
+		return self.arrival_index.peek(node.type, node.cost)
 	
 	#
-	# next_deadline_work_unit(self, node)
+	# next_deadline_job(self, node)
 	#
-	# Same as DeadlineCostScheduler(Scheduler).next_work_unit(node)
+	# Same as DeadlineCostScheduler(Scheduler).next_job(node)
 	# 
-	def next_deadline_work_unit(self, node):
-		job_queue = defaultdict(list) 
-			
-		for unit in self.grid.get_queued():
-			# Only want jobs of the specified type in the queue.
-			if unit.job.job_type == node['type']:
-				job_queue[unit.job.job_id].append(unit)
-
-		# No jobs to schedule of this type!
-		if len(job_queue) == 0:
-			return None
-
-		# Get the node's cost from the node JSON
-		node_cost = node['cost']
-		earliest_deadline = None
-
-		work_unit_to_send = None
-		for job_id, units in job_queue.items():
-			# Check that job runs on node that is within
-			# the job's budget
-			budget_per_node_hour = units[0].job.budget_per_node_hour
-			if budget_per_node_hour >= node_cost:
-		
-				deadline = int(units[0].job.deadline)
-				wall_seconds = walltime.wall_secs(units[0].job.wall_time)
-				time_left = deadline - wall_seconds
-
-				# If we don't have a deadline, assign the
-				# first job's deadline as earliest
-				if earliest_deadline is None:
-					earliest_deadline = time_left
-					work_unit_to_send = job_queue[job_id][0]
-
-				# Handle case of >1 jobs with varying deadlines
-				elif time_left < earliest_deadline:
-					earliest_deadline = time_left
-					work_unit_to_send = job_queue[job_id][0]
-			
-				# Handle case where the deadlines are the same but budgets is higher
-				elif time_left == earliest_deadline and units[0].job.budget_per_node_hour > work_unit_to_send.job.budget_per_node_hour:
-					work_unit_to_send = job_queue[job_id][0]
-
-		return work_unit_to_send
+	def next_deadline_job(self, node):
+		# Only want jobs of the node's type within the node's cost.
+		return self.deadline_index.peek(node.type, node.cost)
 				
 	#
-	# next_round_robin_work_unit(self, node):
+	# next_round_robin_work_units(self, node, count):
 	#
-	# Cost constrained version of RoundRobin(Scheduler).next_work_unit(node)
+	# Cost constrained version of RoundRobin(Scheduler).next_work_units(node, count)
 	#
 
-	def next_round_robin_work_unit(self, node):	
-		job_queue = defaultdict(list)
-
-		# Add all the jobs to the queue
-		for unit in self.grid.get_queued():
+	def next_round_robin_work_units(self, node, count):	
+		# Only jobs of the node's type which meet the cost 
+		# constraints of the node are in its rotation.
+		job_rotation = self.rotation_index.get_tier(node.type, node.cost)
 
-			# Add unique job ids of the given job type to local queue
-			if unit.job.job_type == node['type']:
-				if unit.job.job_id not in self.job_id_queue and unit.job.job_type == node['type']:
-					self.job_id_queue.append(unit.job.job_id)
-					
-				job_queue[unit.job.job_id].append(unit)
-		
-		# No jobs to schedule of this type!
-		if len(job_queue) == 0:
-			return None
-		
-		# Write job_id_queue to the log for clarity.
-		self.write_to_log(str(self.job_id_queue))
-
-		work_unit_to_send = None
-		# Want to send the first work unit of the first job which meets 
-		# the cost constraints of the node
-		for job_id in self.job_id_queue:
-			if job_queue[job_id][0].job.budget_per_node_hour >= node['cost']:
-				work_unit_to_send = job_queue[job_id][0]
-				
-				# need to remove the job id from the deque and put it on the end.
-				# if its the last work unit of the job dont add it back to the deque.
-				self.job_id_queue.remove(job_id)
-				if len(job_queue[job_id]) > 1:
-					self.job_id_queue.append(job_id)
-
-				# Found our first work unit which meets cost constraint, break.
-				break
-		
-		return work_unit_to_send
+		return self.take_round_robin_work_units(count, job_rotation)
 
 #
 # NodeUnavailableException
@@ -0,0 +1,206 @@
+import os
+import threading
+from Queue import Queue, Empty
+from collections import deque
+from itertools import islice
+
+# Log levels, lines below the log's level are dropped
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+	'DEBUG': DEBUG,
+	'INFO': INFO,
+	'WARNING': WARNING,
+	'ERROR': ERROR,
+}
+
+#
+# SchedulerLog
+#
+# The log written by the schedulers of The Grid.
+#
+# The most recent lines are kept in memory for the console, in a
+# ring buffer of at most LINES lines. Each line is numbered from
+# the start of the log, so clients can ask for the lines after the
+# last one they saw, even as older lines are dropped.
+#
+# Every line is also written to the log file at path, which is
+# rotated once it grows past MAX_BYTES. The last BACKUPS files are
+# kept as path.1, path.2, ... with path.1 the most recent.
+#
+# Lines are written to the file by a background thread, in batches
+# of up to BATCH_LINES lines with one flush per batch, so writing to
+# the log never waits on the disk.
+#
+# on_write is called after each write, e.g. to wake clients which
+# are waiting for new lines.
+#
+
+class SchedulerLog(object):
+
+	LINES = 1000
+
+	MAX_BYTES = 10 * 1024 * 1024
+
+	BACKUPS = 5
+
+	BATCH_LINES = 1000
+
+	def __init__(self, path, lines = LINES, max_bytes = MAX_BYTES, backups = BACKUPS, 
+		level = INFO, on_write = None):
+
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.level = level
+		self.on_write = on_write
+
+		self.lock = threading.Lock()
+
+		self.lines = deque(maxlen = lines)
+
+		# The id the next line will be given
+		self.next_id = 0
+
+		self.file = open(self.path, "a")
+
+		# Lists of lines waiting to be written to the file
+		self.pending = Queue()
+
+		self.writer = threading.Thread(target = self.write_pending)
+		self.writer.name = "Master:Grid:SchedulerLog:Writer"
+		self.writer.daemon = True
+		self.writer.start()
+
+	#
+	# @property last_id(self)
+	#
+	# The id of the last line written, or -1 if there is none
+	#
+
+	@property
+	def last_id(self):
+		return self.next_id - 1
+
+	#
+	# is_enabled(self, level)
+	#
+	# Whether lines of the given level are written to the log
+	#
+
+	def is_enabled(self, level):
+		return level >= self.level
+
+	#
+	# write(self, text, level = INFO)
+	#
+	# Writes the text to the log, line by line
+	#
+
+	def write(self, text, level = INFO):
+		self.write_lines(text.splitlines(True), level)
+
+	#
+	# write_lines(self, lines, level = INFO)
+	#
+	# Writes a list of lines, each ending in a newline, to the log
+	#
+
+	def write_lines(self, lines, level = INFO):
+		if not self.is_enabled(level) or not lines:
+			return
+
+		with self.lock:
+			self.lines.extend(lines)
+			self.next_id += len(lines)
+
+		self.pending.put(lines)
+
+		if self.on_write is not None:
+			self.on_write()
+
+	#
+	# write_pending(self)
+	#
+	# Writes lines to the log file as they are logged, until 
+	# the log is closed
+	#
+
+	def write_pending(self):
+		closed = False
+		while not closed:
+			batch = [ self.pending.get() ]
+
+			# Take whatever else has been logged since
+			try:
+				while len(batch) < self.BATCH_LINES:
+					batch.append(self.pending.get_nowait())
+			except Empty:
+				pass
+
+			for lines in batch:
+				if lines is None:
+					closed = True
+					break
+				self.file.writelines(lines)
+				if self.file.tell() > self.max_bytes:
+					self.rotate()
+
+			self.file.flush()
+
+		self.file.close()
+
+	#
+	# rotate(self)
+	#
+	# Moves the log file to path.1, and any older files up one
+	# place, dropping the oldest.
+	#
+
+	def rotate(self):
+		self.file.close()
+
+		for i in range(self.backups - 1, 0, -1):
+			older = "%s.%d" % (self.path, i)
+			if os.path.exists(older):
+				os.rename(older, "%s.%d" % (self.path, i + 1))
+
+		if self.backups > 0:
+			os.rename(self.path, "%s.1" % self.path)
+			self.file = open(self.path, "a")
+		else:
+			self.file = open(self.path, "w")
+
+	#
+	# get_lines(self, after = None, limit = 100)
+	#
+	# Returns a list of (id, line) of the lines after the line
+	# with id after, or of the last lines if after is None, up
+	# to limit lines. Lines which have been dropped from memory
+	# are skipped.
+	#
+
+	def get_lines(self, after = None, limit = 100):
+		with self.lock:
+			first_id = self.next_id - len(self.lines)
+
+			if after is None:
+				start = max(len(self.lines) - limit, 0)
+			else:
+				start = max(after + 1 - first_id, 0)
+
+			return [ (first_id + start + i, line) for i, line in
+				enumerate(islice(self.lines, start, start + limit)) ]
+
+	#
+	# close(self)
+	#
+	# Writes any lines still waiting to the file and closes it
+	#
+
+	def close(self):
+		self.pending.put(None)
+		self.writer.join()
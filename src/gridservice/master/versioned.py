@@ -0,0 +1,253 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+
+#
+# Versioned
+#
+# A base class for objects of The Grid whose state is served as
+# JSON. Setting any attribute counts as a change, and bumps the
+# object's version. Changes which don't set an attribute, such as
+# appending to a list, must call changed() themselves.
+#
+# cached_json(key, encode) keeps the last JSON encoded by the
+# object, so unchanged objects are only encoded once however often
+# they are asked for. The key must include the object's version,
+# and the version of anything else the JSON is built from.
+#
+# Subclasses must call Versioned.__init__ before setting any other
+# attribute, and name any attributes which are not part of the
+# object's state in UNVERSIONED.
+#
+# seq is the ChangeLog sequence number of the object's last change,
+# for objects which are kept in a ChangeLog.
+#
+
+class Versioned(object):
+
+	__slots__ = [ 'version', 'json_cache', 'seq' ]
+
+	UNVERSIONED = frozenset([ 'version', 'json_cache', 'seq' ])
+
+	def __init__(self):
+		object.__setattr__(self, 'version', 0)
+		object.__setattr__(self, 'json_cache', None)
+		object.__setattr__(self, 'seq', 0)
+
+	def __setattr__(self, name, value):
+		object.__setattr__(self, name, value)
+
+		if name not in self.UNVERSIONED:
+			self.changed()
+
+	def changed(self):
+		object.__setattr__(self, 'version', self.version + 1)
+
+	#
+	# cached_json(self, key, encode)
+	#
+	# Returns the JSON cached for key, or calls encode to
+	# create and cache it. The key and JSON are cached as one
+	# tuple so a request thread never sees one without the other.
+	#
+
+	def cached_json(self, key, encode):
+		cache = self.json_cache
+		if cache is not None and cache[0] == key:
+			return cache[1]
+
+		data = encode()
+		object.__setattr__(self, 'json_cache', (key, data))
+		return data
+
+#
+# ChangeLog
+#
+# Keeps the jobs and nodes of The Grid in the order they last 
+# changed, so clients can ask for only what has changed since 
+# they last looked.
+#
+# Every change is given the next number in a sequence. A client
+# is given the current sequence number as a cursor along with the 
+# state it asks for, and passes it back to get the changes made
+# since. A work unit's change is also a change to its job.
+#
+# Objects which change again before anyone has read the cursor
+# keep their sequence number, so a burst of changes to one object
+# costs no more than one.
+#
+# Clients can wait() for the next change rather than polling. Other
+# events clients may be waiting on, such as new scheduler log lines,
+# are announced with notify().
+#
+
+class ChangeLog(object):
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.condition = threading.Condition(self.lock)
+		self.seq = 0
+		self.read_seq = 0
+
+		# job_id -> Job and node_id -> Node, in the order they changed
+		self.jobs = OrderedDict()
+		self.nodes = OrderedDict()
+
+	def job_changed(self, job):
+		with self.lock:
+			self.touch(self.jobs, job.job_id, job)
+
+	def node_changed(self, node):
+		with self.lock:
+			self.touch(self.nodes, node.node_id, node)
+
+	def work_unit_changed(self, unit):
+		with self.lock:
+			self.touch(self.jobs, unit.job.job_id, unit.job)
+			object.__setattr__(unit, 'seq', unit.job.seq)
+
+	#
+	# touch(self, index, key, obj)
+	#
+	# Moves the object to the end of the index with the next
+	# sequence number. Returns False if the object already has
+	# the latest, unread, sequence number. Must be called with
+	# the lock held.
+	#
+
+	def touch(self, index, key, obj):
+		if obj.seq == self.seq and self.seq > self.read_seq:
+			return False
+
+		self.seq += 1
+		object.__setattr__(obj, 'seq', self.seq)
+
+		index.pop(key, None)
+		index[ key ] = obj
+
+		self.condition.notify_all()
+		return True
+
+	#
+	# notify(self)
+	#
+	# Wakes any clients waiting for changes
+	#
+
+	def notify(self):
+		with self.lock:
+			self.condition.notify_all()
+
+	#
+	# wait(self, ready, timeout)
+	#
+	# Waits up to timeout seconds until ready() returns True.
+	# ready is called with the lock held whenever there has been 
+	# a change. Returns the last result of ready().
+	#
+
+	def wait(self, ready, timeout):
+		end = time.time() + timeout
+
+		with self.lock:
+			while not ready():
+				remaining = end - time.time()
+				if remaining <= 0:
+					return False
+				self.condition.wait(remaining)
+
+			return True
+
+	#
+	# has_changed(self, since)
+	#
+	# Whether anything has changed after the cursor. Must be
+	# called with the lock held, e.g. from a wait() callback.
+	#
+
+	def has_changed(self, since):
+		return self.seq > since
+
+	#
+	# cursor(self)
+	#
+	# Returns the current cursor
+	#
+
+	def cursor(self):
+		with self.lock:
+			self.read_seq = self.seq
+			return self.seq
+
+	#
+	# changed_jobs(self, since)
+	# changed_nodes(self, since)
+	#
+	# Return the cursor and the objects which have changed 
+	# after the given cursor, in the order they changed.
+	#
+
+	def changed_jobs(self, since):
+		with self.lock:
+			self.read_seq = self.seq
+			return self.seq, self.changed(self.jobs, since)
+
+	def changed_nodes(self, since):
+		with self.lock:
+			self.read_seq = self.seq
+			return self.seq, self.changed(self.nodes, since)
+
+	#
+	# changes(self, since)
+	#
+	# Returns the cursor, and the jobs and nodes which have 
+	# changed after the given cursor
+	#
+
+	def changes(self, since):
+		with self.lock:
+			self.read_seq = self.seq
+			return self.seq, self.changed(self.jobs, since), self.changed(self.nodes, since)
+
+	def changed(self, index, since):
+		changed = []
+		for key in reversed(index):
+			obj = index[ key ]
+			if obj.seq <= since:
+				break
+			changed.append(obj)
+
+		changed.reverse()
+		return changed
+
+#
+# json_list(fragments)
+#
+# Joins already encoded JSON values into a JSON list
+#
+
+def json_list(fragments):
+	return "[%s]" % ", ".join(fragments)
+
+#
+# json_object(items)
+#
+# Joins (key, already encoded JSON value) pairs into a JSON
+# object. Keys are converted to strings, as json.dumps would.
+#
+
+def json_object(items):
+	return "{%s}" % ", ".join(
+		"%s: %s" % (json.dumps(str(key)), fragment) for key, fragment in items
+	)
+
+#
+# json_extend(data, key, fragment)
+#
+# Adds a key with an already encoded JSON value to the end of
+# an encoded, non-empty JSON object
+#
+
+def json_extend(data, key, fragment):
+	return "%s, %s: %s}" % (data[:-1], json.dumps(key), fragment)
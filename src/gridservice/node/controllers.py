@@ -7,17 +7,15 @@ import gridservice.node.utils as node_utils
 
 from gridservice import http
 from gridservice.http import require_json, authenticate, JSONResponse
-from gridservice.node.model import TaskNotFoundException, InputFileNotFoundException, ExecutableNotFoundException
+from gridservice.node.model import TaskNotFoundException
 
-def auth_server(func):
-	def decorator_func(*args, **kwargs):
-		return authenticate(model.SERVERS)(func)(*args, **kwargs)
-	return decorator_func
+auth_server = authenticate(model.SERVERS)
 
 #
 # task_POST(request)
 #
-# Adds a WorkUnit from The Grid as a task on the Node.
+# Adds a WorkUnit from The Grid as a task on the Node. Replies as
+# soon as the task is created; its files are staged in the background.
 #
 
 @require_json
@@ -28,18 +26,17 @@ def task_POST(request):
 		['work_unit_id', 'job_id', 'executable', 'filename', 'flags', 'wall_time', 'deadline']):
 		return JSONResponse({ 'error_msg': 'Invalid Job JSON received.' }, http.BAD_REQUEST)
 
-	try:
-		task = model.server.add_task(
-			job_id = d['job_id'],
-			work_unit_id = d['work_unit_id'],
-			executable = d['executable'],
-			filename = d['filename'],
-			flags = d['flags'],
-			wall_time = d['wall_time'],
-			deadline = d['deadline']
-		)
-	except (InputFileNotFoundException, ExecutableNotFoundException) as e:
-		return JSONResponse({ 'error_msg': e.args[0] }, http.BAD_REQUEST)
+	task = model.server.add_task(
+		job_id = d['job_id'],
+		work_unit_id = d['work_unit_id'],
+		executable = d['executable'],
+		filename = d['filename'],
+		flags = d['flags'],
+		wall_time = d['wall_time'],
+		deadline = d['deadline'],
+		executable_checksum = d.get('executable_checksum'),
+		file_checksum = d.get('file_checksum')
+	)
 
 	return JSONResponse({ 'success': 'Task created.', 'task_id': task.task_id }, 200)
 
@@ -0,0 +1,148 @@
+import os
+import errno
+import shutil
+import threading
+from collections import OrderedDict
+
+#
+# FileCache
+#
+# The executables and input files a Node has downloaded, kept by
+# their SHA-256 so that tasks of the same job, or of jobs which
+# share files, don't download them again.
+#
+# Cached files are hardlinked into a task's directory, or copied
+# if the cache is on a different filesystem. Removing a task's
+# files or evicting a file from the cache doesn't affect the other.
+# Cached files are made read-only, so a task can't change the copy
+# later tasks are given through its link. They are left executable,
+# as executables are cached too.
+#
+# The least recently used files are evicted once the cache holds
+# more than max_bytes. Files larger than max_bytes aren't cached.
+#
+
+class FileCache(object):
+
+	PATH = os.path.join("www", "cache")
+
+	MAX_BYTES = 1024 * 1024 * 1024
+
+	# Read-only, and executable
+	MODE = 0555
+
+	def __init__(self, path = PATH, max_bytes = MAX_BYTES):
+		self.path = path
+		self.max_bytes = max_bytes
+
+		self.lock = threading.Lock()
+
+		# checksum -> size, least recently used first
+		self.files = OrderedDict()
+		self.size = 0
+
+		if not os.path.exists(self.path):
+			os.makedirs(self.path)
+
+		self.load()
+
+	#
+	# load(self)
+	#
+	# Adds the files left in the cache directory by a previous
+	# run, least recently used first
+	#
+
+	def load(self):
+		files = []
+		for checksum in os.listdir(self.path):
+			path = self.cache_path(checksum)
+			stat = os.stat(path)
+			os.chmod(path, self.MODE)
+			files.append((stat.st_atime, checksum, stat.st_size))
+
+		for atime, checksum, size in sorted(files):
+			self.files[ checksum ] = size
+			self.size += size
+
+		with self.lock:
+			self.evict()
+
+	def cache_path(self, checksum):
+		return os.path.join(self.path, checksum)
+
+	def __contains__(self, checksum):
+		return checksum in self.files
+
+	#
+	# get(self, checksum, path)
+	#
+	# Links the cached file with the given checksum to path.
+	# Returns False if the file isn't cached.
+	#
+
+	def get(self, checksum, path):
+		with self.lock:
+			if checksum not in self.files:
+				return False
+
+			# Most recently used
+			self.files[ checksum ] = self.files.pop(checksum)
+
+			if os.path.exists(path):
+				os.remove(path)
+			link_file(self.cache_path(checksum), path)
+			return True
+
+	#
+	# add(self, checksum, path)
+	#
+	# Adds the file at path to the cache, evicting the least
+	# recently used files to make room for it
+	#
+
+	def add(self, checksum, path):
+		size = os.path.getsize(path)
+		if size > self.max_bytes:
+			return
+
+		with self.lock:
+			if checksum in self.files:
+				return
+
+			cache_path = self.cache_path(checksum)
+			link_file(path, cache_path)
+			os.chmod(cache_path, self.MODE)
+
+			self.files[ checksum ] = size
+			self.size += size
+
+			self.evict()
+
+	#
+	# evict(self)
+	#
+	# Removes the least recently used files until the cache is
+	# within max_bytes. Must be called with the lock held.
+	#
+
+	def evict(self):
+		while self.size > self.max_bytes:
+			checksum, size = self.files.popitem(last = False)
+			self.size -= size
+			os.remove(self.cache_path(checksum))
+
+#
+# link_file(source, dest)
+#
+# Hardlinks dest to source, or copies source to dest if they are
+# on different filesystems
+#
+
+def link_file(source, dest):
+	try:
+		os.link(source, dest)
+	except OSError as e:
+		if e.errno not in [ errno.EXDEV, errno.EPERM, errno.EMLINK ]:
+			raise
+		shutil.copyfile(source, dest)
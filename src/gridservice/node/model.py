@@ -6,8 +6,10 @@ import shlex
 import shutil
 import multiprocessing
 import thread
+import socket
 
-from threading import Thread
+from threading import Thread, Lock
+from Queue import Queue, Full
 from urllib2 import HTTPError, URLError
 from httplib import HTTPException
 
@@ -15,6 +17,8 @@ import gridservice.node.monitor as monitor
 import gridservice.node.utils as node_utils
 
 from gridservice.http import auth_header, HTTPRequest, FileHTTPRequest, JSONHTTPRequest
+from gridservice.http import FileDownload, DownloadException
+from gridservice.node.filecache import FileCache
 import gridservice.walltime as walltime
 
 SERVERS = [
@@ -28,7 +32,21 @@ class NodeServer(object):
 	HEARTBEAT_INTERVAL = 5
 	MONITOR_INTERVAL = 1
 
-	def __init__(self, username, password, host, port, ghost, gport, cost, cores, programs):
+	# Downloads are retried after DOWNLOAD_RETRY_INTERVAL seconds,
+	# doubling after each failure
+	DOWNLOAD_MAX_ATTEMPTS = 5
+	DOWNLOAD_RETRY_INTERVAL = 1
+
+	# The number of tasks which can have their files staged at once
+	STAGING_WORKERS = 4
+
+	# The number of files The Grid has asked to be prefetched which
+	# can be waiting at once; any more are ignored
+	PREFETCH_MAX_PENDING = 16
+	PREFETCH_PATH = os.path.join("www", "staging")
+
+	def __init__(self, username, password, host, port, ghost, gport, cost, cores, programs, 
+		cache_size = FileCache.MAX_BYTES):
 
 		self.username = username
 		self.password = password
@@ -42,10 +60,27 @@ class NodeServer(object):
 		self.next_task_id = 0
 		self.retry_attempts = 0
 
+		# Guards tasks, next_task_id and tasks leaving PENDING
+		self.tasks_lock = Lock()
+
 		self.programs = programs
 		self.cost = int(cost)
 
 		self.auth_header = auth_header(self.username, self.password)
+
+		# Executables and input files already downloaded
+		self.cache = FileCache(max_bytes = cache_size)
+
+		# Tasks waiting for their files to be staged
+		self.staging_queue = Queue()
+		self.start_stagers()
+
+		# Files waiting to be prefetched, and the checksums of 
+		# those waiting or being fetched
+		self.prefetch_queue = Queue(self.PREFETCH_MAX_PENDING)
+		self.prefetching = set()
+		self.prefetch_lock = Lock()
+		self.start_prefetcher()
 	
 		if cores <= 0:
 			try:
@@ -89,19 +124,23 @@ class NodeServer(object):
 
 	def reset_node_state(self):
 		print "Reconnected to The Grid. Resetting."
-		# Kill all active tasks
-		for task in self.tasks.values():
-			task.kill()
-		
-		# Remove all task related files
-		path = os.path.join('www', 'tasks')
-		if os.path.exists(path):
-			shutil.rmtree(path)
+		with self.tasks_lock:
+			# Kill all active tasks, and stop any still being staged
+			for task in self.tasks.values():
+				if task.is_pending():
+					task.cancel()
+				else:
+					task.kill()
+			
+			# Remove all task related files
+			path = os.path.join('www', 'tasks')
+			if os.path.exists(path):
+				shutil.rmtree(path)
 
-		# Reset internal state
-		self.tasks = {}
-		self.next_task_id = 0
-		self.retry_attempts = 0
+			# Reset internal state
+			self.tasks = {}
+			self.next_task_id = 0
+			self.retry_attempts = 0
 
 	#
 	# register_node(self)
@@ -130,79 +169,270 @@ class NodeServer(object):
 
 			
 	#
-	# add_task(self, job_id, work_unit_id, executable, filename, flags, wall_time, deadline)
+	# add_task(self, job_id, work_unit_id, executable, filename, flags, wall_time, deadline,
+	#	executable_checksum = None, file_checksum = None)
+	#
+	# Takes the given task variables and creates a new PENDING task, and
+	# queues it to have its files staged, which in turn executes the task.
+	# Returns the task straight away; if staging fails, The Grid is told
+	# by report_staging_failure. Files whose checksums are given are taken
+	# from the cache if they have been downloaded before.
+	#
+
+	def add_task(self, job_id, work_unit_id, executable, filename, flags, wall_time, deadline,
+		executable_checksum = None, file_checksum = None):
+		with self.tasks_lock:
+			# create the task
+			task = Task(
+				task_id = self.next_task_id, 
+				job_id = job_id,
+				work_unit_id = work_unit_id,
+				executable = executable, 
+				filename = filename,
+				flags = flags, 
+				wall_time = walltime.strptime(wall_time),
+				deadline = deadline
+			)
+		
+			self.tasks.update({ task.task_id: task })
+			self.next_task_id += 1
+
+		self.staging_queue.put((task, executable_checksum, file_checksum))
+
+		return task
+
 	#
-	# Takes the given task variables and creates a new task, requests the
-	# required file from the server, and readies the task for execution, which
-	# in turn executes the task.
+	# Staging
 	#
 
-	def add_task(self, job_id, work_unit_id, executable, filename, flags, wall_time, deadline):
-		# create the task
-		task = Task(
-			task_id = self.next_task_id, 
-			job_id = job_id,
-			work_unit_id = work_unit_id,
-			executable = executable, 
-			filename = filename,
-			flags = flags, 
-			wall_time = walltime.strptime(wall_time),
-			deadline = deadline
-		)
+	def start_stagers(self):
+		for i in range(self.STAGING_WORKERS):
+			stager = Thread(target = self.stager)
+			stager.name = "Node:Stager:%d" % i
+			stager.daemon = True
+			stager.start()
 
-		# Get the files for the task
-		self.get_task_executable(task)
-		self.get_task_file(task)
+	#
+	# stager(self)
+	#
+	# Stages the tasks in the staging queue. Any error staging a 
+	# task is reported to The Grid, so the stager carries on with 
+	# the next task.
+	#
 
-		# Task is now READY
-		task.ready()
-	
-		self.tasks.update({ task.task_id: task })
-		self.next_task_id += 1
+	def stager(self):
+		while True:
+			task, executable_checksum, file_checksum = self.staging_queue.get()
+			try:
+				self.stage_task(task, executable_checksum, file_checksum)
+			except Exception as e:
+				self.report_staging_failure(task, "%s: %s" % (e.__class__.__name__, e))
 
-		return task
-	
 	#
-	# get_task_executable(self, task)
+	# stage_task(self, task, executable_checksum, file_checksum)
 	#
-	# Requests the executable file required by the given task from the
-	# server and saves the file to disk
+	# Gets the files for a PENDING task and executes it, unless the
+	# task was killed while its files were being fetched.
 	#
 
-	def get_task_executable(self, task):
+	def stage_task(self, task, executable_checksum, file_checksum):
+		if task.is_cancelled():
+			self.cleanup_task_files(task)
+			return
+
 		try:
-			url = "%s/job/%s/executable/%s" % (self.grid_url, task.job_id, task.executable)
-			request = HTTPRequest( 'GET', url, "", self.auth_header)
-		except(HTTPException, URLError) as e:
-			node_utils.request_error_cli(e, "Unable to establish a connection to The Grid")
-			sys.exit(1)
+			self.get_task_executable(task, executable_checksum)
+			self.get_task_file(task, file_checksum)
 
-		# This will be horrible with large files
+			with self.tasks_lock:
+				if task.is_cancelled():
+					self.cleanup_task_files(task)
+					return
 
-		fp = open(task.executable_path, 'w+')
-		fp.write(request.response)
-		fp.close()
+				# Task is now READY
+				task.ready()
+		except (TaskFileDownloadException, InputFileNotFoundException, ExecutableNotFoundException) as e:
+			self.report_staging_failure(task, e.args[0])
 
 	#
-	# get_task_file(self, task)
+	# Prefetching
 	#
-	# Requests the file required by the given task from the 
-	# server and saves the file to disk
+
+	def start_prefetcher(self):
+		self.prefetch_thread = Thread(target = self.prefetcher)
+		self.prefetch_thread.name = "Node:Prefetcher"
+		self.prefetch_thread.daemon = True
+		self.prefetch_thread.start()
+
+	#
+	# prefetch(self, hints)
 	#
+	# Queues the files The Grid expects the node to need next to 
+	# be fetched into the cache, skipping those already cached or
+	# queued. Each hint is a dict of job_id, type, filename and
+	# checksum.
+	#
+
+	def prefetch(self, hints):
+		for hint in hints:
+			checksum = hint['checksum']
+
+			with self.prefetch_lock:
+				if checksum in self.prefetching or checksum in self.cache:
+					continue
+
+				try:
+					self.prefetch_queue.put_nowait(hint)
+				except Full:
+					return
+
+				self.prefetching.add(checksum)
+
+	def prefetcher(self):
+		while True:
+			hint = self.prefetch_queue.get()
+			try:
+				self.prefetch_file(hint)
+			except Exception as e:
+				print "Unable to prefetch %s: %s: %s" % (hint['checksum'], e.__class__.__name__, e)
+			finally:
+				with self.prefetch_lock:
+					self.prefetching.discard(hint['checksum'])
+
+	#
+	# prefetch_file(self, hint)
+	#
+	# Downloads a file into the staging area and adds it to
+	# the cache, where the task which needs it will find it
+	#
+
+	def prefetch_file(self, hint):
+		checksum = hint['checksum']
+		if checksum in self.cache:
+			return
+
+		if not os.path.exists(self.PREFETCH_PATH):
+			os.makedirs(self.PREFETCH_PATH)
+
+		url = "%s/job/%s/%s/%s" % (self.grid_url, hint['job_id'], hint['type'], hint['filename'])
+		path = os.path.join(self.PREFETCH_PATH, checksum)
 
-	def get_task_file(self, task):
 		try:
-			url = "%s/job/%s/files/%s" % (self.grid_url, task.job_id, task.filename)
-			request = HTTPRequest( 'GET', url, "", self.auth_header)
-		except (HTTPException, URLError) as e:
-			node_utils.request_error_cli(e, "Unable to establish a connection to The Grid")
-			sys.exit(1)
+			actual = self.download_file(url, path)
+		except TaskFileDownloadException as e:
+			print "Unable to prefetch %s: %s" % (url, e.args[0])
+			return
+
+		if actual == checksum:
+			self.cache.add(checksum, path)
+		os.remove(path)
+
+	#
+	# report_staging_failure(self, task, error_msg)
+	#
+	# Drops a task whose files could not be staged, and tells The
+	# Grid so it can give the work unit to another node. Tasks 
+	# killed while they were being staged have already been 
+	# reported by kill_task.
+	#
+
+	def report_staging_failure(self, task, error_msg):
+		print "Work unit %s of job %s could not be staged: %s" % (task.work_unit_id, task.job_id, error_msg)
+
+		with self.tasks_lock:
+			killed = task.is_cancelled()
+
+			task.cancel()
+			self.remove_task(task)
+
+		self.cleanup_task_files(task)
+
+		if killed:
+			return
+
+		try:
+			url = '%s/job/%s/workunit/requeue' % (self.grid_url, str(task.job_id))
+			request = JSONHTTPRequest( 'POST', url, { 
+				'work_unit_id': task.work_unit_id,
+				'node_id': self.node_id,
+				'task_id': task.task_id,
+				'error_msg': error_msg,
+			}, self.auth_header)
+		except (HTTPException, URLError, socket.error) as e:
+			node_utils.request_error_cli(e, "Unable to establish a connection to the grid")
 	
-		# This will be horrible with large files
+	#
+	# get_task_executable(self, task, checksum = None)
+	#
+	# Requests the executable file required by the given task from the
+	# server and saves the file to disk
+	#
+
+	def get_task_executable(self, task, checksum = None):
+		url = "%s/job/%s/executable/%s" % (self.grid_url, task.job_id, task.executable)
+		self.fetch_file(url, task.executable_path, checksum)
+
+	#
+	# get_task_file(self, task, checksum = None)
+	#
+	# Requests the file required by the given task from the 
+	# server and saves the file to disk
+	#
+
+	def get_task_file(self, task, checksum = None):
+		if not task.filename:
+			return
 
-		fp = open(task.input_path, 'w+')
-		fp.write(request.response)
-		fp.close()
+		url = "%s/job/%s/files/%s" % (self.grid_url, task.job_id, task.filename)
+		self.fetch_file(url, task.input_path, checksum)
+
+	#
+	# fetch_file(self, url, path, checksum = None)
+	#
+	# Links the file with the given checksum to path from the 
+	# cache, or downloads it and adds it to the cache
+	#
+
+	def fetch_file(self, url, path, checksum = None):
+		if checksum is not None and self.cache.get(checksum, path):
+			return
+
+		actual = self.download_file(url, path)
+		if checksum is not None and actual != checksum:
+			os.remove(path)
+			raise TaskFileDownloadException("Checksum of %s does not match %s." % (url, checksum))
+
+		self.cache.add(actual, path)
+
+	#
+	# download_file(self, url, path)
+	#
+	# Downloads a file from The Grid to path, resuming the download
+	# if it fails part way. Gives up with a TaskFileDownloadException
+	# after DOWNLOAD_MAX_ATTEMPTS attempts, or straight away if The
+	# Grid refuses the request.
+	#
+
+	def download_file(self, url, path):
+		download = FileDownload(url, path, self.auth_header)
+
+		for attempt in range(self.DOWNLOAD_MAX_ATTEMPTS):
+			try:
+				return download.attempt()
+			except HTTPError as e:
+				node_utils.request_error_cli(e, "Unable to download %s" % url)
+
+				# Only retry errors that may go away
+				if e.code < 500 and e.code not in [ 408, 416 ]:
+					break
+			except (HTTPException, URLError, DownloadException, IOError, OSError) as e:
+				node_utils.request_error_cli(e, "Unable to download %s" % url)
+
+			if attempt < self.DOWNLOAD_MAX_ATTEMPTS - 1:
+				time.sleep(self.DOWNLOAD_RETRY_INTERVAL * 2 ** attempt)
+
+		download.discard()
+		raise TaskFileDownloadException("Unable to download %s from The Grid." % url)
 
 	#
 	# get_task(self, task_id)
@@ -214,10 +444,11 @@ class NodeServer(object):
 		if isinstance(task_id, str) and task_id.isdigit():
 			task_id = int(task_id)
 
-		if task_id in self.tasks:
-			return self.tasks[ task_id ]
-		else:
-			raise TaskNotFoundException("There is no task with the id: %s" % task_id)
+		with self.tasks_lock:
+			if task_id in self.tasks:
+				return self.tasks[ task_id ]
+
+		raise TaskNotFoundException("There is no task with the id: %s" % task_id)
 
 	#
 	# send_task_output(self, task)
@@ -248,26 +479,58 @@ class NodeServer(object):
 	#
 
 	def cleanup_task_files(self, task):
-		cwd = os.getcwd()
-		os.chdir(os.path.join("www", "tasks"))
-		subprocess.Popen(['rm', '-rf', "%s/" % task.task_id])
-		os.chdir(cwd)
+		# Don't chdir, other threads use paths relative to the cwd
+		subprocess.Popen(['rm', '-rf', os.path.join("www", "tasks", str(task.task_id))])
 	
 	#
 	# kill_task(self, task, kill_msg)
 	#
 	# Kills a running process and forces the immediate return
 	# of any output files created. Sends back reason for kill 
-	# to The Grid.
+	# to The Grid. A task which hasn't started running yet is 
+	# cancelled, and reported to The Grid without any output.
+	# Tasks which have already finished or been killed are left
+	# alone.
 	#
 
 	def kill_task(self, task, kill_msg=None):
-		task.outfile.close()
-		task.errfile.close()
+		with self.tasks_lock:
+			if not self.remove_task(task):
+				return
+
+			# Stop the task from running once its files are staged
+			running = task.is_running()
+			if not running:
+				task.cancel()
+
+		if not running:
+			self.cleanup_task_files(task)
+			self.report_task_finished(task, kill_msg)
+			return
+
+		if task.outfile is not None:
+			task.outfile.close()
+		if task.errfile is not None:
+			task.errfile.close()
 
 		task.kill()
 		self.finish_task(task, kill_msg)
-		del self.tasks[task.task_id]
+
+	#
+	# remove_task(self, task)
+	#
+	# Removes the task from the node's tasks. Returns False if it
+	# has already been removed, so only one thread finishes or 
+	# kills each task. Must be called with the tasks lock held.
+	#
+
+	def remove_task(self, task):
+		if self.tasks.get(task.task_id) is not task:
+			return False
+
+		del self.tasks[ task.task_id ]
+		return True
+
 	#
 	# finish_task(self, task)
 	#
@@ -281,21 +544,31 @@ class NodeServer(object):
 
 		self.send_task_output(task)
 		self.cleanup_task_files(task)
+		self.report_task_finished(task, kill_msg)
+
+		# Update the task internally to reflect that the server has 
+		# received all files and the complete status.
+		task.finish()
+
+	#
+	# report_task_finished(self, task, kill_msg = None)
+	#
+	# Informs The Grid the task is complete, or was killed
+	# with kill_msg, so it can free the task's core.
+	#
 
-		# Inform the server the task is complete
+	def report_task_finished(self, task, kill_msg = None):
 		try:
 			url = '%s/job/%s/workunit' % (self.grid_url, str(task.job_id))
 			request = JSONHTTPRequest( 'POST', url, { 
 				'work_unit_id': task.work_unit_id,
+				'node_id': self.node_id,
+				'task_id': task.task_id,
 				'kill_msg': kill_msg,
 			}, self.auth_header)
 		except (HTTPException, URLError) as e:
 			node_utils.request_error_cli(e, "Unable to establish a connection to the grid")
 
-		# Update the task internally to reflect that the server has 
-		# received all files and the complete status.
-		task.finish()
-
 	#
 	# Heartbeat
 	#
@@ -321,6 +594,9 @@ class NodeServer(object):
 				request = JSONHTTPRequest( 'POST', url, { 
 					'cpu': self.mon.cpu(),
 				}, self.auth_header)
+
+				# Fetch the files we're likely to need next
+				self.prefetch(request.response.get('prefetch', []))
 			except (HTTPException, URLError) as e:
 				
 				node_utils.request_error_cli(e, 
@@ -364,14 +640,24 @@ class NodeServer(object):
 	#
 
 	def monitor_tasks(self):
-		if len(self.tasks) != 0:
-			print self.tasks
+		with self.tasks_lock:
+			tasks = self.tasks.values()
+
+		if len(tasks) != 0:
+			print tasks
 		
-		for i, task in list(self.tasks.items()):
+		for task in tasks:
+			# Still being staged
+			if not task.is_running():
+				continue
+
 			# Check if a task has finished
 			if task.has_finished():
-				self.finish_task(task)
-				del self.tasks[i]
+				with self.tasks_lock:
+					finished = self.remove_task(task)
+
+				if finished:
+					self.finish_task(task)
 
 			# Kill task if its exceeded it wall time
 			elif (int(time.time()) - task.running_ts) > walltime.wall_secs(task.wall_time):
@@ -388,7 +674,10 @@ class NodeServer(object):
 #
 # A task is the Node's representation of a Work Unit from the server.
 #
-# PENDING = Task is created but may still be modified
+# PENDING = Task is created but may still be modified, its files 
+# are being staged
+# CANCELLED = Task was killed, or its files could not be staged, 
+# before it was executed
 # READY = Task is ready to be executed, added to queue
 # RUNNING = Task has been executed and is still running, or 
 # has finished but has not yet been updated by the task monitor
@@ -439,6 +728,16 @@ class Task(object):
 		self.status = "FINISHED"
 		self.finished_ts = int(time.time())
 
+	def cancel(self):
+		self.status = "CANCELLED"
+		self.finished_ts = int(time.time())
+
+	def is_pending(self):
+		return self.status == "PENDING"
+
+	def is_cancelled(self):
+		return self.status == "CANCELLED"
+
 	def is_ready(self):
 		return self.status == "READY"
 
@@ -509,13 +808,19 @@ class Task(object):
 			if not os.path.exists(self.input_path):
 				raise InputFileNotFoundException("Input file %s not found." % self.filename)
 			else:
-				self.infile = open(self.input_path, "r+")
+				# Input files may be shared with the cache, so 
+				# must not be written to
+				self.infile = open(self.input_path, "r")
 
 		self.outfile = open(self.output_path, "w+")
 		self.errfile = open(self.error_path, "w+")
 		
-		# Change the permissions of the executable file to allow execution
-		subprocess.Popen(['chmod', '775', self.executable_path])
+		# Change the permissions of the executable file to allow execution.
+		# Executables linked from the cache are already executable, and
+		# must be left read-only.
+		mode = os.stat(self.executable_path).st_mode
+		if mode & 0111 != 0111:
+			os.chmod(self.executable_path, mode | 0111)
 
 		# A bug in shlex causes it to spaz out on non-ascii strings
 		# in Python 2.6, so we convert the string to ascii and ignore
@@ -569,3 +874,10 @@ class TaskNotFoundException(Exception):
 
 class ServerUnavailableException(Exception):
 	pass
+
+#
+# TaskFileDownloadException
+#
+
+class TaskFileDownloadException(Exception):
+	pass
@@ -1,5 +1,8 @@
 from urllib2 import HTTPError, URLError
 from httplib import HTTPException
+import socket
+
+from gridservice.http import DownloadException
 
 def request_error_cli(e, err_str):
 	if isinstance(e, HTTPError):
@@ -8,5 +11,7 @@ def request_error_cli(e, err_str):
 		print "%s\nMessage: %s" % (err_str, e.message)
 	elif isinstance(e, URLError):
 		print "%s\nMessage: %s" % (err_str, e.reason)
+	elif isinstance(e, (DownloadException, socket.error)):
+		print "%s\nMessage: %s" % (err_str, e)
 	else:
 		print "An unknown error occured with your request: %r" % e
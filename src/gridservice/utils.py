@@ -47,19 +47,77 @@ def validate_request(req, fields):
 
 
 #
-# route(routes, env)
+# Router
+#
+# The routes of an app, compiled once when the app is made.
+#
+# Routes are kept by method. Routes without path variables are 
+# looked up by path in a dict, and routes with them are kept with
+# the literal prefix of their expr, so only the routes whose prefix
+# matches the path have their regular expression tried. The first
+# matching route in the table wins, as if every route were tried
+# in order.
+#
+
+class Router(object):
+
+	def __init__(self, routes):
+		# method -> { path: (position, func) }
+		self.literals = {}
+
+		# method -> [ (position, prefix, parser, func) ]
+		self.patterns = {}
+
+		for position, ((expr, method), func) in enumerate(routes):
+			match = ROUTE_VAR_PARSER.search(expr)
+			if match is None:
+				self.literals.setdefault(method, {}).setdefault(expr, (position, func))
+			else:
+				self.patterns.setdefault(method, []).append(
+					(position, expr[:match.start()], route_expr_to_parser(expr), func)
+				)
+
+	#
+	# find(self, path, method)
+	#
+	# Returns the function and path variables of the first route
+	# matching the path and method, or False if there is none
+	#
+
+	def find(self, path, method):
+		literal = self.literals.get(method, {}).get(path)
+		last = literal[0] if literal is not None else None
+
+		for position, prefix, parser, func in self.patterns.get(method, ()):
+			if last is not None and position > last:
+				break
+
+			if not path.startswith(prefix):
+				continue
+
+			match = parser.match(path)
+			if match:
+				return ( func, match.groupdict() )
+
+		if literal is not None:
+			return ( literal[1], {} )
+
+		return False
+
+#
+# route(router, env)
 #
 # Determines the route based on the environment and 
-# calls relevant function from the routes map. 
+# calls relevant function from the router. 
 #
 
-def route(routes, env):
+def route(router, env):
 	request = Request(env)
 
 
 	#print "Request: " + str( request.raw )
 
-	route = route_find(routes, env)
+	route = router.find(env['PATH_INFO'], env['REQUEST_METHOD'])
 	if route: 
 		func, func_vars = route
 		if func_vars:
@@ -69,42 +127,15 @@ def route(routes, env):
 	else:
 		return JSONResponse({'error_msg': 'Request not found'}, http.NOT_FOUND)
 
-#
-# route_find(routes, env)
-#
-# Iterates the routes and attempts to find a match
-#
+# We need to convert the nice route syntax to a regex to parse
+# the path from the enviroment to test if a route matches
 
-def route_find(routes, env):
-	for route, func in routes:
-		match = route_match(route, env['PATH_INFO'], env['REQUEST_METHOD'])
-		if match != False:
-			return ( func, match )
-
-	return False
-
-#
-# route_match(route, path, method)
-#
-# Compares a route to the path and method and returns
-# any path variables if they are found.
-#
-
-def route_match(route, path, method):
-	expr, req_method = route
-
-	# If the method doesn't match, no point going farther
-	if req_method != method:
-		return False
-
-	# Now we can use our newly built regex to see if the path matches
-	route_parser = route_expr_to_parser(expr)
-	match = route_parser.match(path)
-
-	if match:
-		return match.groupdict()
-	else:
-		return False
+ROUTE_VAR_PARSER = re.compile(r'''
+	\{            # The exact character "{"
+	(\w+)         # The variable name (restricted to a-z, 0-9, _)
+	(?::([^}]+))? # The optional :regex part
+	\}            # The exact character "}"
+''', re.VERBOSE)
 
 #
 # route_expr_to_parser(expr)
@@ -115,19 +146,9 @@ def route_match(route, path, method):
 #
 
 def route_expr_to_parser(expr):
-
-	# We need to convert the nice route syntax to a regex to parse
-	# the path from the enviroment to test if this route matches
-	expr_parser = re.compile(r'''
-		\{            # The exact character "{"
-		(\w+)         # The variable name (restricted to a-z, 0-9, _)
-		(?::([^}]+))? # The optional :regex part
-		\}            # The exact character "}"
-	''', re.VERBOSE)
-	
 	regex = ""
 	last_pos = 0
-	for match in expr_parser.finditer(expr):
+	for match in ROUTE_VAR_PARSER.finditer(expr):
 		regex += re.escape(expr[last_pos:match.start()])
 
 		var_name = match.group(1)
@@ -146,26 +167,26 @@ def route_expr_to_parser(expr):
 	return route_parser
 
 #
-# server(routes, env, start_response)
+# server(router, env, start_response)
 #
-# A WSGI application that takes a map of routes, the
+# A WSGI application that takes a Router, the
 # environment and the start_response passed from the 
 # WSGI server and returns the response.
 # 
 
-def server(routes, env, start_response):
-	response = route(routes, env)
+def server(router, env, start_response):
+	response = route(router, env)
 	return response.get_response(start_response)
 
 #
 # make_app(routes)
 # 
-# A utility function for calling server, creates a 
-# partial function pointer, passing routes as the 
-# first argument to server. This function pointer 
+# A utility function for calling server, compiles the
+# routes into a Router and creates a partial function 
+# pointer, passing it as the first argument to server. This function pointer 
 # can be passed directly to a WSGI server as an
 # application.
 #
 
 def make_app(routes):
-	return functools.partial(server, routes)
+	return functools.partial(server, Router(routes))
@@ -8,6 +8,8 @@ import gridservice.utils
 import gridservice.node.controllers as controllers
 import gridservice.node.model as model
 
+from gridservice.node.filecache import FileCache
+
 routes = [
 	(('/task', 'POST'), controllers.task_POST),
 	(('/task/{id:\d+}', 'DELETE'), controllers.task_id_DELETE),
@@ -50,9 +52,13 @@ if __name__ == '__main__':
 		help="The number of cores of the node available. If blank, total available will be detected.", 
 		metavar="CORES", default = 0)
 
+	parser.add_option("--cache-size", dest="cache_size",
+		help="The disk space in bytes used to cache executables and input files", 
+		metavar="BYTES", type = "int", default = FileCache.MAX_BYTES)
+
 	(options, args) = parser.parse_args()
 	
-	model.server = model.NodeServer(options.username, options.password, options.host, options.port, options.ghost, options.gport, options.cost, options.cores, args)
+	model.server = model.NodeServer(options.username, options.password, options.host, options.port, options.ghost, options.gport, options.cost, options.cores, args, options.cache_size)
 
 	# Initialise the WSGI Server
 	reloader.install()		
@@ -9,6 +9,7 @@ import gridservice.master.controllers as controllers
 import gridservice.master.model as model
 
 from gridservice.master.grid import Grid, InvalidSchedulerException
+from gridservice.master.schedulerlog import SchedulerLog, LEVELS
 
 routes = [
 	(('/scheduler', 'PUT'), controllers.scheduler_PUT),
@@ -31,6 +32,7 @@ routes = [
 	(('/job/{id:\d+}/{type:\w+}/{path:[A-z0-9./]+}', 'PUT'), controllers.job_files_PUT),
 
 	(('/job/{id:\d+}/workunit', 'POST'), controllers.job_workunit_POST),
+	(('/job/{id:\d+}/workunit/requeue', 'POST'), controllers.job_workunit_requeue_POST),
 	
 	# All my beautiful JSON for the UI
 
@@ -44,6 +46,7 @@ routes = [
 	(('/json/job/submit-file/{tmp_job_id:\d+}/', 'POST'), controllers.job_submit_file_POST),
 	(('/json/job/submit-executable/{tmp_job_id:\d+}/', 'POST'), controllers.job_submit_executable_POST),
 	(('/json/logs', 'GET'), controllers.log_GET),
+	(('/json/stream', 'GET'), controllers.stream_GET),
 
 	# Serve files directly from disk 
 	(('/', 'GET'), controllers.index_GET),
@@ -75,11 +78,43 @@ if __name__ == '__main__':
 		help="The scheduling algorithm to be used by The Grid", 
 		metavar="SCHEDULER", default = "FCFS")
 
+	parser.add_option("-t", "--threads", dest="threads",
+		help="The number of requests the server can handle at once, including open console streams", 
+		metavar="THREADS", type = "int", default = 30)
+
+	parser.add_option("--log-lines", dest="log_lines",
+		help="The number of scheduler log lines kept in memory for the console", 
+		metavar="LINES", type = "int", default = SchedulerLog.LINES)
+
+	parser.add_option("--log-size", dest="log_size",
+		help="The size in bytes the scheduler log file is rotated at", 
+		metavar="BYTES", type = "int", default = SchedulerLog.MAX_BYTES)
+
+	parser.add_option("--log-backups", dest="log_backups",
+		help="The number of rotated scheduler log files to keep", 
+		metavar="BACKUPS", type = "int", default = SchedulerLog.BACKUPS)
+
+	parser.add_option("--log-level", dest="log_level",
+		help="The lowest level of scheduler log lines to write: DEBUG, INFO, WARNING or ERROR", 
+		metavar="LEVEL", type = "choice", choices = LEVELS.keys(), default = "INFO")
+
+	parser.add_option("--max-upload", dest="max_upload",
+		help="The largest file in bytes that can be uploaded to The Grid", 
+		metavar="BYTES", type = "int", default = None)
+
 	(options, args) = parser.parse_args()
 
+	log = SchedulerLog("scheduler_log.txt", 
+		lines = options.log_lines, 
+		max_bytes = options.log_size, 
+		backups = options.log_backups,
+		level = LEVELS[ options.log_level ])
+
+	model.MAX_UPLOAD_SIZE = options.max_upload
+
 	# Bring the Grid online
 	try:
-		model.grid = Grid(options.username, options.password, options.scheduler)
+		model.grid = Grid(options.username, options.password, options.scheduler, log)
 	except InvalidSchedulerException:
 		print "Invalid Scheduler %s. Valid schedulers: %s." % (options.scheduler, ", ".join(Grid.SCHEDULERS))
 		sys.exit(1)
@@ -92,7 +127,7 @@ if __name__ == '__main__':
 
 	app = gridservice.utils.make_app(routes)
 	try:
-		httpserver.serve(app, host = host, port = port)
+		httpserver.serve(app, host = host, port = port, threadpool_workers = options.threads)
 	except Exception:
 		print 'Unable to start The Grid on this host and port, please try a different host and port.'
 		sys.exit(1)
@@ -12,9 +12,43 @@ function cmdconsole() {
 	this.job_count=1;
 	this.tmp_job_id =-1;
 
+	// Cursors of the last update and log line, so only
+	// what has changed since is streamed
+	this.cursor = null;
+	this.log_cursor = null;
+
+	// The least time between the start of one stream request and the next
+	this.stream_interval = 1000;
+
+	// Streams updates from The Grid. Each request waits for the 
+	// next change, and the next request is made once it returns,
+	// but no sooner than stream_interval after the last one started.
 	function do_updates() {
-		update();
-		setTimeout( do_updates, 1500 )
+		var started = new Date().getTime();
+
+		$.ajax({
+			url: stream_url(),
+			success: function (response) {
+				var delta = _.cursor != null;
+
+				render_nodes(response.nodes, delta);
+				render_jobs(response.jobs, delta);
+				render_logs(response.log);
+
+				_.cursor = next_cursor(_.cursor, response.cursor);
+				_.log_cursor = response.log_cursor;
+
+				var wait = started + _.stream_interval - new Date().getTime();
+				setTimeout( do_updates, Math.max(wait, 0) );
+			},
+			error: function () {
+				// Start again from the full state, The Grid may have restarted
+				_.cursor = null;
+				_.log_cursor = null;
+
+				setTimeout( do_updates, 1500 );
+			}
+		});
 	}
 
 	function node_id(n) {
@@ -64,14 +98,22 @@ function cmdconsole() {
 		}
 	}
 
-	function render_nodes(updates) {
-		$("#nodes li").addClass("remove");
+	// Given a full list of nodes, removes any nodes not in it. Given
+	// only the nodes that have changed, removes those that have died.
+	function render_nodes(updates, delta) {
+		if (!delta) $("#nodes li").addClass("remove");
 
 		for (var i = 0; i < updates.length; i++) {
 			// Check to see if we already have a node here?
 			var n = updates[i];
 
 			var li = $("#" + node_id(n) );
+			if (n.status == "DEAD"){
+				li.remove();
+				continue;
+			}
+			li.find("li").addClass("remove");
+
 			if (li.length==0){
 				// Create a new list item for you please!
 				li = $("#node-template").clone();
@@ -79,7 +121,7 @@ function cmdconsole() {
 				$("#nodes").append( li );
 
 				var cpuh = [];
-				for (var i=0; i < 60; i++){
+				for (var b=0; b < 60; b++){
 					bar = $("<div>");
 					bar.addClass("bar");
 					li.find("div.cpu-chart").append(bar)
@@ -111,8 +153,9 @@ function cmdconsole() {
 				}
 			}
 
+			li.find("li.remove").remove()
 		}
-		$("#nodes li.remove").remove()
+		if (!delta) $("#nodes li.remove").remove()
 	}
 
 	function createWorkUnit(w, wid, ul){
@@ -160,8 +203,10 @@ function cmdconsole() {
 		}
 	} 
 
-	function render_jobs(updates) {
-		$("#jobs li").addClass("remove");
+	// Given only the jobs that have changed, with only their changed
+	// work units, leaves every other job as it is.
+	function render_jobs(updates, delta) {
+		if (!delta) $("#jobs li").addClass("remove");
 
 		for (var i = 0; i < updates.length; i++) {
 			// Check to see if we already have a node here?
@@ -264,37 +309,20 @@ function cmdconsole() {
 
 
 		}
-		$("#jobs li.remove").remove()
+		if (!delta) $("#jobs li.remove").remove()
 	}
 
-	function update() {
-		$.ajax({
-			url: "/json/nodes",
-			success: function (response) {
-				render_nodes(response.nodes);
-			},
-			error: function () {
-			}
-		});
-
-
-		$.ajax({
-			url: "/json/jobs",
-			success: function (response) {
-				render_jobs(response.jobs);
-			},
-			error: function () {
-			}
-		});
+	// Adds the cursors to the stream url, if there are any
+	function stream_url() {
+		if (_.cursor == null) return "/json/stream";
+		return "/json/stream?since=" + _.cursor + "&log=" + _.log_cursor;
+	}
 
-		$.ajax({
-			url: "/json/logs",
-			success: function (response) {
-				render_logs(response.log);
-			},
-			error: function () {
-			}
-		});
+	// A cursor that has gone backwards means The Grid has restarted,
+	// so start again from the full state
+	function next_cursor(cursor, new_cursor) {
+		if (cursor != null && new_cursor < cursor) return null;
+		return new_cursor;
 	}
 
 	do_updates();